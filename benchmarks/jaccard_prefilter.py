@@ -0,0 +1,82 @@
+'''
+Benchmark of the two paths of finder.jaccard_matrix: the overlapping pairs with one sparse product (prefilter=False),
+and only the pairs allowed by the size bound, one overlap per pair (prefilter=True); and of the default
+(prefilter=None), whose time includes the cost of its check of the size bound.
+
+The cluster sets are the partitions of a network with n nodes into clusters with power-law sizes, as found by the CD
+algorithm at one resolution, against a slightly perturbed copy (as at a neighboring resolution, 'near') or against a
+partition into 4 times fewer clusters (as at a distant resolution, 'far'). The prefilter reads the members of both
+clusters of each pair left by the size bound, while the product costs one multiply-add per node shared by two clusters
+(about one per node when comparing two partitions). The 'work' column is the number of members read by the prefilter per multiply-add of the product.
+
+Results (n=10000, --repeat 5, numpy 2.4, scipy 1.17), a few rows of the 90 cases:
+
+ clusters  exponent other threshold pairs left     work  product (s) prefilter (s)  speedup  auto (s)
+       10       0.5  near      0.50      0.820    15.29      0.00036      0.00201     0.18   0.00037
+       10       0.5  near      0.90      0.190     3.41      0.00033      0.00056     0.58   0.00036
+       10       0.5   far      0.50      0.100     1.36      0.00032      0.00050     0.64   0.00034
+       10       0.5   far      0.75      0.033     0.45      0.00031      0.00044     0.70   0.00034
+       10       1.0   far      0.90      0.033     0.36      0.00032      0.00041     0.77   0.00035
+       10       0.5   far      0.90      0.000     0.00      0.00032      0.00019     1.67   0.00013
+      998       0.5  near      0.50      0.615  1016.93      0.00081      0.13830     0.01   0.00054
+     1000       0.5   far      0.90      0.015    19.97      0.00094      0.00287     0.33   0.00087
+
+The prefilter was faster in 2 cases out of 90, both with no pair left (work 0). At the lowest work with pairs left
+(0.36 to 0.97) it was 0.64 to 0.77 times as fast as the product, and slower still as the work grows. So the automatic
+choice does not weigh the two paths: it only sorts the sizes to check whether the size bound leaves any pair, returns
+no pair if none is left, and uses the product otherwise. The check costs about 0.03 to 0.05 ms (auto against product),
+and saves about half of the product when no pair is left.
+
+usage: python benchmarks/jaccard_prefilter.py [--n 10000] [--repeat 5]
+'''
+import argparse, timeit, itertools
+import numpy as np
+from hidef import finder
+
+def random_partition(rng, n, n_clusters, exponent):
+    '''a membership vector of n nodes in n_clusters clusters whose sizes follow a power law'''
+    weights = 1.0 / np.arange(1, n_clusters + 1) ** exponent
+    return rng.choice(n_clusters, size=n, p=weights / weights.sum())
+
+def perturb(rng, membership, fraction):
+    '''move a fraction of the nodes to random clusters'''
+    membership = membership.copy()
+    moved = rng.random(len(membership)) < fraction
+    membership[moved] = rng.choice(membership.max() + 1, size=np.count_nonzero(moved))
+    return membership
+
+def main():
+    par = argparse.ArgumentParser()
+    par.add_argument('--n', type=int, default=10000, help='number of nodes')
+    par.add_argument('--repeat', type=int, default=5, help='number of timed runs of each case (the best is reported)')
+    par.add_argument('--seed', type=int, default=0)
+    args = par.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    print('{:>9} {:>9} {:>5} {:>9} {:>10} {:>8} {:>12} {:>12} {:>8} {:>9}'.format(
+        'clusters', 'exponent', 'other', 'threshold', 'pairs left', 'work', 'product (s)', 'prefilter (s)', 'speedup',
+        'auto (s)'))
+    for n_clusters, exponent, other in itertools.product([10, 50, 200, 1000, 3000], [0.5, 1.0, 2.0], ['near', 'far']):
+        membership = random_partition(rng, args.n, n_clusters, exponent)
+        matA = finder.partition_to_membership_matrix(membership, minsize=1)
+        if other == 'near':
+            matB = finder.partition_to_membership_matrix(perturb(rng, membership, 0.05), minsize=1)
+        else:
+            matB = finder.partition_to_membership_matrix(random_partition(rng, args.n, n_clusters // 4 + 1, exponent),
+                                                         minsize=1)
+        for threshold in [0.5, 0.75, 0.9]:
+            sizeA, sizeB = matA.getnnz(axis=1), matB.getnnz(axis=1)
+            left = 1.0 * len(finder.size_bound_pairs(sizeA, sizeB, threshold)[0]) / (matA.shape[0] * matB.shape[0])
+            product_work = np.dot(matA.getnnz(axis=0).astype(np.int64), matB.getnnz(axis=0))
+            work = 1.0 * finder.size_bound_work(sizeA, sizeB, threshold) / product_work
+            product = min(timeit.repeat(lambda: finder.jaccard_matrix(matA, matB, threshold, prefilter=False),
+                                        number=1, repeat=args.repeat))
+            prefilter = min(timeit.repeat(lambda: finder.jaccard_matrix(matA, matB, threshold, prefilter=True),
+                                          number=1, repeat=args.repeat))
+            auto = min(timeit.repeat(lambda: finder.jaccard_matrix(matA, matB, threshold, prefilter=None),
+                                     number=1, repeat=args.repeat))
+            print('{:>9d} {:>9.1f} {:>5} {:>9.2f} {:>10.3f} {:>8.2f} {:>12.5f} {:>12.5f} {:>8.2f} {:>9.5f}'.format(
+                matA.shape[0], exponent, other, threshold, left, work, product, prefilter, product / prefilter, auto))
+
+if __name__ == '__main__':
+    main()
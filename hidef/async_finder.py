@@ -0,0 +1,137 @@
+import asyncio, contextlib
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from hidef import finder, weaver, LOGGER
+
+__all__ = ['AsyncFinder']
+
+def _step(gen):
+    return next(gen, None)
+
+class AsyncFinder(object):
+    '''
+    asyncio front end of the finder: the run -> consensus -> weave pipeline as coroutines that do not block the event
+    loop. Each step of finder.iter_run (the runs of the CD algorithm at one resolution) is done in an executor, so a job
+    can be cancelled between two resolutions; at most max_jobs jobs run at the same time. With workers > 1, the
+    resolutions of a bisection level are sampled together by the workers, so such a run is cancelled between levels
+
+    >>> hidef = AsyncFinder(max_jobs=4)
+    >>> cluG, collapsed, wv = await hidef.pipeline(G, maxn=20, k=5)
+    '''
+
+    def __init__(self, max_jobs=4, executor=None):
+        '''initialize
+        max_jobs: maximum number of jobs (runs, consensus or weaving) at the same time; the others wait
+        executor: a thread pool executor (concurrent.futures.ThreadPoolExecutor) for the steps; by default one of
+        max_jobs threads. A process pool cannot be used, as the steps share their generator with the event loop
+         '''
+        self.max_jobs = max_jobs
+        self._executor = executor if executor is not None else ThreadPoolExecutor(max_jobs)
+        self._semaphore = None # created in the event loop, on first use
+
+    def _jobs(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_jobs)
+        return self._semaphore
+
+    async def _call(self, func, *args):
+        async with self._jobs():
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def iter_run(self, G, **kwargs):
+        '''
+        asynchronous version of finder.iter_run; yields a finder.ResolutionEvent after each sampled resolution.
+        Cancelling the consumer (or closing this generator) stops the run once the current resolution (the current
+        bisection level with workers > 1) is finished
+        :param G: input network; an igraph graph, or a scipy.sparse adjacency matrix
+        :param kwargs: parameters of finder.iter_run
+        '''
+        async with self._jobs():
+            gen = finder.iter_run(G, **kwargs)
+            step = None
+            try:
+                while True:
+                    step = self._executor.submit(_step, gen)
+                    # the step itself cannot be interrupted; it is shielded so that it is not marked as cancelled
+                    # before it is really finished
+                    event = await asyncio.shield(asyncio.wrap_future(step))
+                    if event is None:
+                        return
+                    yield event
+            finally:
+                try:
+                    if step is not None and not step.done():
+                        LOGGER.info('Run cancelled; stopping after the current resolution')
+                        # the job keeps its slot until the step is finished, so that no more than max_jobs steps run
+                        # at the same time; its result (or error) is of no use anymore
+                        with contextlib.suppress(Exception):
+                            await asyncio.shield(asyncio.wrap_future(step))
+                finally:
+                    # the generator is closed (its workers stopped) once the step is finished; if this job is cancelled
+                    # again while waiting, by the thread of the step. Nothing new is submitted, so this is safe after
+                    # shutdown
+                    if step is None or step.done():
+                        gen.close()
+                    else:
+                        step.add_done_callback(lambda _: gen.close())
+
+    async def run(self, G, callback=None, **kwargs):
+        '''
+        asynchronous version of finder.run
+        :param G: input network; an igraph graph, or a scipy.sparse adjacency matrix
+        :param callback: a function called (in the event loop) with each finder.ResolutionEvent; None to ignore them
+        :param kwargs: parameters of finder.iter_run
+        :return: the ClusterGraph
+        '''
+        event = None
+        async for event in self.iter_run(G, **kwargs):
+            if callback is not None:
+                callback(event)
+        return event.cluster_graph
+
+    async def consensus(self, cluG, k=5, f=1.0, ct=100):
+        '''
+        asynchronous version of finder.consensus
+        :return: a list of (collapsed cluster, stability), sorted by cluster size
+        '''
+        return await self._call(finder.consensus, cluG, k, f, ct)
+
+    async def weave(self, cluG_collapsed_w_len, cutoff=0.75):
+        '''
+        build the hierarchy of the consensus clusters, as the command line program does
+        :param cluG_collapsed_w_len: the output of consensus
+        :param cutoff: a containment index cutoff (the command line program uses the Jaccard cutoff)
+        :return: the Weaver object; not woven (its hier is None) if consensus found no cluster
+        '''
+        if not cluG_collapsed_w_len:
+            LOGGER.info('No consensus cluster; nothing to weave')
+            return weaver.Weaver()
+        cluG_collapsed = [x[0] for x in cluG_collapsed_w_len]
+        cluG_collapsed.insert(0, np.ones(len(cluG_collapsed[0]), ))
+
+        def weave():
+            wv = weaver.Weaver()
+            wv.weave(cluG_collapsed, boolean=True, assume_levels=False, merge=True, cutoff=cutoff)
+            return wv
+        return await self._call(weave)
+
+    async def pipeline(self, G, k=5, f=1.0, ct=75, jaccard=0.75, callback=None, **kwargs):
+        '''
+        run -> consensus -> weave
+        :param G: input network; an igraph graph, or a scipy.sparse adjacency matrix
+        :param k: see finder.consensus
+        :param f: see finder.consensus
+        :param ct: see finder.consensus
+        :param jaccard: a Jaccard index cutoff, for both the cluster graph and the hierarchy
+        :param callback: see run
+        :param kwargs: other parameters of finder.iter_run
+        :return: the ClusterGraph, the output of consensus and the Weaver object
+        '''
+        cluG = await self.run(G, callback=callback, jaccard=jaccard, **kwargs)
+        cluG_collapsed_w_len = await self.consensus(cluG, k, f, ct)
+        wv = await self.weave(cluG_collapsed_w_len, jaccard)
+        return cluG, cluG_collapsed_w_len, wv
+
+    def shutdown(self, wait=True):
+        '''shut down the executor'''
+        self._executor.shutdown(wait=wait)
@@ -3,34 +3,54 @@ import leidenalg
 
 import networkx as nx
 import igraph as ig
-import argparse, time, pickle
+import argparse, time, pickle, copy
+import multiprocessing, zlib, bisect, hashlib, heapq
+from collections import namedtuple
 import numpy as np
 import pandas as pd
 import scipy as sp
+import scipy.sparse, scipy.sparse.csgraph
 from networkx.algorithms.community import k_clique_communities
 from hidef import weaver, LOGGER
 
 class Cluster(object):
     __slots__ = ['size',
                  'members',
-                 'binary',
+                 'length',
                  'padded',
-                 'resolution_parameter']
+                 'resolution_parameter',
+                 'replicate',
+                 'count']
 
-    def __init__(self, binary, length, gamma):
+    def __init__(self, binary, length, gamma, replicate=0):
         '''initialize
-        member: a list of member index (start from 0)
+        binary: a sparse row vector (1 x length) of the membership, or the (sorted) indices of the members
+        member: a list of member index (start from 0); only the indices are stored, as int32
         size: number of cluster member
-        length:  
+        length: number of nodes in the network
         gamma: resolution parameter
+        replicate: index of the perturbed replicate at this resolution that found the cluster
+        count: number of runs of the CD algorithm that found exactly this cluster
          '''
-        self.binary = np.squeeze(np.asarray(binary.todense()))
-        self.members = np.where(self.binary)[0]
+        if sp.sparse.issparse(binary):
+            binary = binary.tocsr()
+            binary.sort_indices()
+            binary = binary.indices
+        self.members = np.asarray(binary, dtype=np.int32)
+        self.length = length
         self.size = len(self.members)
         self.resolution_parameter = '{:.4f}'.format(gamma)
         self.padded = False
+        self.replicate = replicate
+        self.count = 1
         # self.index=None
 
+    @property
+    def binary(self):
+        '''dense binary membership vector; built on demand'''
+        binary = np.zeros(self.length, dtype=bool)
+        binary[self.members] = True
+        return binary
 
     def calculate_similarity(self, cluster2):
         '''
@@ -39,65 +59,581 @@ class Cluster(object):
         :return: 
         '''
         # jaccard index
-        arr1, arr2 = self.binary, cluster2.binary
-        both = np.dot(arr1, arr2)
-        either = len(arr1) - np.dot(1-arr1, 1-arr2)
+        both = len(np.intersect1d(self.members, cluster2.members, assume_unique=True))
+        either = self.size + cluster2.size - both
         return 1.0 * both / either
 
-class ClusterGraph(nx.Graph): # inherit networkx digraph
+class GrowableArray(object):
     '''
-    Extending nx.Graph class, each node is a Cluster object
+    A 1-d numpy array with amortized O(1) appends; the storage doubles when it is full
     '''
+    __slots__ = ['_data', '_size']
+
+    def __init__(self, dtype, capacity=16):
+        self._data = np.empty(max(capacity, 1), dtype=dtype)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __getstate__(self):
+        # only pickle the used part of the storage
+        return self.array.copy()
+
+    def __setstate__(self, state):
+        self._data = state
+        self._size = len(state)
+
+    @property
+    def array(self):
+        '''a view of the stored values'''
+        return self._data[:self._size]
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=self._data.dtype).ravel()
+        size = self._size + len(values)
+        if size > len(self._data):
+            data = np.empty(max(size, 2 * len(self._data)), dtype=self._data.dtype)
+            data[:self._size] = self._data[:self._size]
+            self._data = data
+        self._data[self._size:size] = values
+        self._size = size
+
+    def append(self, value):
+        self.extend([value])
+
+class ClusterGraph(object):
+    '''
+    A graph of clusters (found at different resolutions), connecting similar clusters. The members of the clusters are
+    kept in a growable CSR store, and the edges in a COO buffer; Cluster objects are only built on request.
+    Cluster ids are consecutive integers in the order the clusters were added, and stay valid after removals.
+    Clusters are interned by their members: a cluster that is found again (at another resolution or replicate) is not
+    stored twice, instead its count is incremented and its resolution span is extended.
+    With all_to_all, the clusters are also kept in an inverted index (node -> clusters), so that a new cluster can be
+    compared with all the clusters sharing a member with it. The index is a list of CSR blocks (one column per cluster)
+    that are merged as they grow, like the levels of a log-structured merge tree, so that adding clusters is cheap.
+    With minhash, the comparison with all the stored clusters is approximate instead: a MinHash signature is computed
+    once per cluster, the bands of the signatures are hashed into buckets (one table per band), and only the clusters
+    sharing a bucket with a new cluster are compared with it, exactly.
+    The connected components (at sim_threshold) are kept up to date in a union-find forest as edges are added, with
+    their sizes (the number of times their clusters were found), so that they are known at any time of a run.
+    '''
+
+    def __init__(self, num_leaves=0, sim_threshold=0.75, all_to_all=False, weight_floor=0.5, minhash=0, recall=0.95):
+        '''initialize
+        num_leaves: number of nodes in the network
+        sim_threshold: a Jaccard index cutoff to connect two clusters
+        all_to_all: compare new clusters with all stored clusters instead of those of the neighboring resolutions
+        weight_floor: pairs of clusters with a Jaccard index above this value (or sim_threshold if lower) are kept as
+        weighted edges, so that the graph can be viewed at any higher threshold (see threshold)
+        minhash: length of the MinHash signatures with which new clusters are compared with all stored clusters
+        (approximately, see lsh_bands); 0 for exact comparisons
+        recall: with minhash, the probability that a pair of clusters with a Jaccard index at weight_floor is compared,
+        so that the views down to weight_floor are as complete; pairs below weight_floor are compared with a lower
+        probability
+         '''
+        self.graph = {'num_leaves': num_leaves, 'sim_threshold': sim_threshold, 'all_to_all': all_to_all,
+                      'weight_floor': min(weight_floor, sim_threshold), 'minhash': minhash, 'recall': recall}
+        self._signatures = GrowableArray(np.uint32) # minhash values per cluster, flattened
+        self._buckets = [{} for _ in range(lsh_bands(self.graph['weight_floor'], minhash, recall)[0])] if minhash else []
+        self._index_blocks = [] # (node x cluster CSR matrix of int32, ids of its columns), the largest first
+        self._indptr = GrowableArray(np.int64)
+        self._indptr.append(0)
+        self._indices = GrowableArray(np.int32)
+        self._resolution = GrowableArray(np.float64)
+        self._replicate = GrowableArray(np.int32)
+        self._padded = GrowableArray(bool)
+        self._removed = GrowableArray(bool)
+        self._n_removed = 0
+        self._n_dead = 0 # number of members of the removed clusters still in the store
+        self._count = GrowableArray(np.int32)
+        self._res_min = GrowableArray(np.float64)
+        self._res_max = GrowableArray(np.float64)
+        self._lookup = {} # (size, hash of the members) -> ids of the clusters
+        self._pruned = {} # (size, hash of the members) -> (count, lowest and highest resolution) of a pruned cluster
+        self._pruned_members = {} # id -> members of a pruned cluster, if kept for the partitions (see prune)
+        self._edge_row = GrowableArray(np.int32)
+        self._edge_col = GrowableArray(np.int32)
+        self._edge_weight = GrowableArray(np.float32)
+        self._edge_keys = [] # sorted arrays of the keys (lower id << 32 | higher id) of the edges, the largest first
+        self._parent = GrowableArray(np.int64) # union-find forest of the components
+        self._component_size = GrowableArray(np.int64) # size of the component of each root; 0 for the other ids
+
+    def __len__(self):
+        return self.number_of_nodes()
+
+    def number_of_nodes(self):
+        '''number of (not removed) clusters'''
+        return len(self._resolution) - self._n_removed
+
+    def number_of_edges(self):
+        return len(self.edges()[0])
+
+    def nodes(self):
+        '''ids of the (not removed) clusters'''
+        return np.flatnonzero(~self._removed.array)
+
+    def edges(self, threshold=None, weight=False):
+        '''
+        the edges between (not removed) clusters
+        :param threshold: only the edges with a Jaccard index above this value; None for sim_threshold
+        :param weight: also return the Jaccard indices
+        :return: two arrays of cluster ids (and an array of Jaccard indices)
+        '''
+        if threshold is None:
+            threshold = self.graph['sim_threshold']
+        row, col, w = self._edge_row.array, self._edge_col.array, self._edge_weight.array
+        kept = w > np.float32(threshold)
+        if self._n_removed:
+            kept &= ~(self._removed.array[row] | self._removed.array[col])
+        row, col, w = row[kept], col[kept], w[kept]
+        return (row, col, w) if weight else (row, col)
+
+    def threshold(self, sim_threshold):
+        '''
+        view the cluster graph at another Jaccard index cutoff, without comparing the clusters again
+        :param sim_threshold: a Jaccard index cutoff, not lower than weight_floor
+        :return: a ClusterGraph that shares the clusters and edges of this one (treat it as read-only)
+        '''
+        if sim_threshold < self.graph['weight_floor']:
+            raise ValueError('edges with a Jaccard index below %.2f were not kept' % self.graph['weight_floor'])
+        view = copy.copy(self)
+        view.graph = dict(self.graph, sim_threshold=sim_threshold)
+        view._rebuild_components()
+        return view
+
+    def members(self, i):
+        '''member indices of cluster i'''
+        indptr = self._indptr.array
+        return self._indices.array[indptr[i]:indptr[i+1]]
+
+    def pruned_members(self, i):
+        '''member indices of the pruned cluster i, or None if they were not kept (see prune)'''
+        return self._pruned_members.get(i)
+
+    def counts(self, ids=None):
+        '''
+        :param ids: cluster ids; None for all clusters
+        :return: the number of times each cluster was found
+        '''
+        return self._count.array if ids is None else self._count.array[ids]
+
+    def resolution_span(self, i):
+        '''the lowest and highest resolutions at which cluster i was found'''
+        return self._res_min.array[i], self._res_max.array[i]
+
+    def cluster(self, i):
+        '''
+        build the Cluster object of a cluster id
+        :param i: a cluster id
+        :return: a Cluster object
+        '''
+        clu = Cluster(self.members(i), self.graph['num_leaves'], self._resolution.array[i], self._replicate.array[i])
+        clu.padded = bool(self._padded.array[i])
+        clu.count = int(self._count.array[i])
+        return clu
+
+    def find(self, members):
+        '''
+        :param members: sorted member indices
+        :return: the id of the (not removed) cluster with exactly these members, or -1 if there is none
+        '''
+        members = np.asarray(members, dtype=np.int32)
+        for i in self._lookup.get(_members_key(members), ()):
+            if np.array_equal(self.members(i), members):
+                return i
+        return -1
+
+    def membership_matrix(self, ids=None):
+        '''
+        :param ids: cluster ids; None for all clusters (rows of removed clusters are empty)
+        :return: scipy.sparse.csr_matrix (boolean), one row per cluster, one column per node in the network
+        '''
+        if ids is None and self._n_dead:
+            self.compact()
+        indptr, indices = self._indptr.array, self._indices.array
+        n = self.graph['num_leaves']
+        if ids is None:
+            return sp.sparse.csr_matrix((np.ones(len(indices), dtype=bool), indices, indptr.copy()),
+                                        shape=(len(indptr) - 1, n))
+        ids = np.asarray(ids, dtype=np.int64)
+        starts, sizes = indptr[ids], indptr[ids + 1] - indptr[ids]
+        sub_indptr = np.zeros(len(ids) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=sub_indptr[1:])
+        # gather the index ranges of the selected rows
+        positions = np.repeat(starts - sub_indptr[:-1], sizes) + np.arange(sub_indptr[-1])
+        return sp.sparse.csr_matrix((np.ones(len(positions), dtype=bool), indices[positions], sub_indptr),
+                                    shape=(len(ids), n))
+
+    def adjacency(self):
+        '''symmetric adjacency matrix (scipy.sparse.csr_matrix) between all cluster ids'''
+        n = len(self._resolution)
+        row, col = self.edges()
+        A = sp.sparse.coo_matrix((np.ones(len(row), dtype=bool), (row, col)), shape=(n, n))
+        return (A + A.T).tocsr()
+
+    def connected_components(self):
+        '''
+        connected components of the cluster graph, without the removed clusters
+        :return: a list of arrays of cluster ids, ordered by their lowest id
+        '''
+        ids = self.nodes()
+        # number the components in the order of their lowest id
+        roots, first, labels = np.unique(self._roots()[ids], return_index=True, return_inverse=True)
+        labels = np.argsort(np.argsort(first))[labels]
+        order = np.argsort(labels, kind='stable')
+        splits = np.flatnonzero(np.diff(labels[order])) + 1
+        return np.split(ids[order], splits) if len(ids) else []
+
+    def append_clusters(self, matrix, resolution, replicates=None, counts=None):
+        '''
+        store new clusters without connecting them; a cluster identical to a stored one is not stored again
+        :param matrix: scipy.sparse.csr_matrix, membership matrix of the new clusters
+        :param resolution: resolution parameter of the new clusters (a number, or one per cluster)
+        :param replicates: replicate index of each new cluster; None for 0
+        :param counts: number of times each new cluster was found; None for 1
+        :return: the id of each row of matrix; rows that repeat a stored cluster (or an earlier row) get its id
+        '''
+        matrix = matrix.tocsr()
+        matrix.sort_indices()
+        n_new = matrix.shape[0]
+        resolution = np.broadcast_to(np.asarray(resolution, dtype=np.float64), (n_new,))
+        replicates = np.zeros(n_new, dtype=np.int32) if replicates is None else np.asarray(replicates)
+        counts = np.ones(n_new, dtype=np.int32) if counts is None else np.asarray(counts)
+        ids = np.empty(n_new, dtype=np.int64)
+        novel = []
+        for row in range(n_new):
+            members = matrix.indices[matrix.indptr[row]:matrix.indptr[row + 1]].astype(np.int32)
+            i = self.find(members)
+            if i < 0:
+                # a pruned cluster that is found again carries on with its count and resolution span
+                count, res_min, res_max = self._pruned.pop(_members_key(members), (0, np.inf, -np.inf))
+                i = len(self._resolution)
+                self._indptr.append(self._indptr.array[-1] + len(members))
+                self._indices.extend(members)
+                self._resolution.append(resolution[row])
+                self._replicate.append(replicates[row])
+                self._padded.append(False)
+                self._removed.append(False)
+                self._count.append(count + counts[row])
+                self._res_min.append(min(res_min, resolution[row]))
+                self._res_max.append(max(res_max, resolution[row]))
+                self._lookup.setdefault(_members_key(members), []).append(i)
+                self._parent.append(i)
+                self._component_size.append(count + counts[row])
+                novel.append(i)
+            else:
+                self._count.array[i] += counts[row]
+                self._component_size.array[self.component(i)] += counts[row]
+                self._res_min.array[i] = min(self._res_min.array[i], resolution[row])
+                self._res_max.array[i] = max(self._res_max.array[i], resolution[row])
+            ids[row] = i
+        if self.graph.get('minhash') and novel:
+            self._hash(np.array(novel))
+        elif self.graph.get('all_to_all') and novel:
+            self._index(np.array(novel))
+        return ids
+
+    def _hash(self, ids):
+        '''compute the signatures of new clusters (the last ids) and add them to the buckets'''
+        signatures = minhash_signatures(self.membership_matrix(ids), self.graph['minhash'])
+        self._signatures.extend(signatures.ravel())
+        for buckets, keys in zip(self._buckets, self._band_keys(signatures).T.tolist()):
+            for i, key in zip(ids.tolist(), keys):
+                buckets.setdefault(key, []).append(i)
+
+    def _band_keys(self, signatures):
+        # tuned to the lowest Jaccard index kept on the edges, not to sim_threshold (see threshold)
+        bands, rows = lsh_bands(self.graph['weight_floor'], self.graph['minhash'], self.graph['recall'])
+        return lsh_keys(signatures, bands, rows)
+
+    def signatures(self, ids=None):
+        '''
+        :param ids: cluster ids; None for all clusters
+        :return: the MinHash signatures of the clusters (minhash only), one row per cluster
+        '''
+        signatures = self._signatures.array.reshape(-1, self.graph['minhash'])
+        return signatures if ids is None else signatures[ids]
+
+    def jaccard(self, row, col):
+        '''
+        :param row: cluster ids
+        :param col: cluster ids
+        :return: the Jaccard index of each pair of clusters
+        '''
+        ids, inverse = np.unique(np.concatenate([row, col]), return_inverse=True)
+        mat = self.membership_matrix(ids)
+        return jaccard_pairs(mat, mat, inverse[:len(row)], inverse[len(row):])
+
+    def _index(self, ids):
+        '''add clusters to the inverted index; the last block is merged into the previous one while not smaller'''
+        # stored as int32, the type of the products of overlaps, so that the blocks are never converted again
+        self._index_blocks.append((self.membership_matrix(ids).T.tocsr().astype(np.int32), ids))
+        while len(self._index_blocks) > 1 and len(self._index_blocks[-2][1]) <= 2 * len(self._index_blocks[-1][1]):
+            (block1, ids1), (block2, ids2) = self._index_blocks[-2:]
+            self._index_blocks[-2:] = [(sp.sparse.hstack([block1, block2], format='csr'), np.concatenate([ids1, ids2]))]
+
+    def overlaps(self, matrix):
+        '''
+        find the stored clusters that share members with some clusters, using the inverted index (all_to_all only)
+        :param matrix: scipy.sparse.csr_matrix, membership matrix of the clusters
+        :return: row indices of matrix, ids of the (not removed) stored clusters, and the numbers of shared members
+        '''
+        matrix = matrix.astype(np.int32)
+        rows, ids, both = [], [], []
+        for block, block_ids in self._index_blocks:
+            overlap = matrix.dot(block).tocoo()
+            rows.append(overlap.row)
+            ids.append(block_ids[overlap.col])
+            both.append(overlap.data)
+        if not rows:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32)
+        rows, ids, both = np.concatenate(rows), np.concatenate(ids), np.concatenate(both)
+        kept = ~self._removed.array[ids]
+        return rows[kept], ids[kept], both[kept]
+
+    def add_edges(self, row, col, weight=1.0):
+        '''
+        connect clusters; self loops and edges that already exist are skipped
+        :param row: cluster ids
+        :param col: cluster ids
+        :param weight: Jaccard index of each edge
+        :return: the edges that were added, as two arrays of cluster ids
+        '''
+        row, col = np.asarray(row, dtype=np.int64), np.asarray(col, dtype=np.int64)
+        weight = np.broadcast_to(np.asarray(weight, dtype=np.float32), row.shape)
+        keys, first = np.unique(np.minimum(row, col) << 32 | np.maximum(row, col), return_index=True)
+        new = ~self._has_edge_keys(keys) & (row[first] != col[first])
+        self._add_edge_keys(keys[new])
+        self._edge_row.extend(row[first[new]])
+        self._edge_col.extend(col[first[new]])
+        self._edge_weight.extend(weight[first[new]])
+        strong = weight[first[new]] > np.float32(self.graph['sim_threshold'])
+        self._union(row[first[new]][strong], col[first[new]][strong])
+        return row[first[new]], col[first[new]]
+
+    def _has_edge_keys(self, keys):
+        found = np.zeros(len(keys), dtype=bool)
+        for block in self._edge_keys:
+            positions = np.minimum(np.searchsorted(block, keys), len(block) - 1)
+            found |= block[positions] == keys
+        return found
+
+    def _add_edge_keys(self, keys):
+        '''add keys (unique and not stored yet); the last block is merged into the previous one while not smaller'''
+        if len(keys) == 0:
+            return
+        self._edge_keys.append(keys)
+        while len(self._edge_keys) > 1 and len(self._edge_keys[-2]) <= 2 * len(self._edge_keys[-1]):
+            self._edge_keys[-2:] = [np.sort(np.concatenate(self._edge_keys[-2:]))]
+
+    def component(self, i):
+        '''
+        :param i: a cluster id
+        :return: the id of the root of the component of cluster i (the same for all the clusters of a component)
+        '''
+        parent = self._parent.array
+        while parent[i] != i:
+            # path halving
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return int(i)
+
+    def component_size(self, i):
+        '''the size of the component of cluster i, i.e. the number of times its clusters were found'''
+        return int(self._component_size.array[self.component(i)])
+
+    def _union(self, row, col):
+        parent, size = self._parent.array, self._component_size.array
+        for i, j in zip(row.tolist(), col.tolist()):
+            i, j = self.component(i), self.component(j)
+            if i != j:
+                # union by size
+                if size[i] < size[j]:
+                    i, j = j, i
+                parent[j] = i
+                size[i] += size[j]
+                size[j] = 0
+
+    def _roots(self):
+        '''the root of the component of each cluster id; the paths of the forest are compressed on the way'''
+        parent = self._parent.array
+        roots = parent[parent]
+        while np.any(roots != parent[roots]):
+            roots = parent[roots]
+        parent[:] = roots
+        return roots
+
+    def _rebuild_components(self):
+        '''build the union-find forest again from the edges (at sim_threshold), e.g. after removing clusters'''
+        n = len(self._resolution)
+        n_components, labels = sp.sparse.csgraph.connected_components(self.adjacency(), directed=False)
+        # the root of a component is its first cluster
+        first = np.full(n_components, n, dtype=np.int64)
+        np.minimum.at(first, labels, np.arange(n))
+        self._parent = GrowableArray(np.int64, n)
+        self._parent.extend(first[labels])
+        size = np.zeros(n, dtype=np.int64)
+        size[first] = np.bincount(labels, weights=np.where(self._removed.array, 0, self._count.array),
+                                  minlength=n_components)
+        self._component_size = GrowableArray(np.int64, n)
+        self._component_size.extend(size)
 
     def add_clusters(self, resolution_graph, new_resolution):
         '''
         Add new clusters to cluster graph once a new resolution is finished by the CD algorithm
-        :param resolution_graph: another nx.Graph object 
+        :param resolution_graph: a ResolutionGraph object 
         :param new_resolution: the resolution just visited by the CD algorithm
-        :return: 
+        :return: the new edges (above sim_threshold), as two arrays of cluster ids
         '''
-        resname_new = '{:.4f}'.format(new_resolution)
-        new_clusters = []
-        new_mat = resolution_graph.nodes[resname_new]['matrix']
-
-        for i in range(new_mat.shape[0]): # c is a list of node indices
-            clu = Cluster(new_mat[i, :], self.graph['num_leaves'], new_resolution)
-            # cluG.add_cluster(clu)
-            new_clusters.append(clu)
+        resname_new = float(new_resolution)
+        # from now on the clusters are kept (once) in the cluster graph only
+        new_mat = resolution_graph.nodes[resname_new].pop('matrix')
+        replicates = resolution_graph.nodes[resname_new]['replicates']
 
+        newnode = self.append_clusters(new_mat, new_resolution, replicates)
+        resolution_graph.nodes[resname_new]['node_indices'] = newnode
 
-        # compare c with all existing clusters in clusterGraph (maybe optimized in future)
-        if len(self.nodes()) == 0:
-            newnode = np.arange(0, len(new_clusters))
+        # compare the distinct clusters of this resolution (all replicates) against each other and against the
+        # distinct clusters of all other resolutions within range; neighboring resolutions mostly share their
+        # clusters, so there are far fewer of those than rows in their matrices
+        new_ids = np.unique(newnode)
+        if len(new_ids) == 0:
+            return new_ids, new_ids
+
+        if self.graph.get('minhash'):
+            id_new, id_c, jac = self._compare_buckets(new_ids)
+        elif self.graph.get('all_to_all'):
+            # compare with every stored cluster sharing a member, the new ones included
+            new_mat = self.membership_matrix(new_ids)
+            row, ids, both = self.overlaps(new_mat)
+            size_new = new_mat.getnnz(axis=1)[row]
+            size = np.diff(self._indptr.array)[ids]
+            # the Jaccard index is at most the ratio of the sizes
+            possible = np.minimum(size_new, size) > self.graph['weight_floor'] * np.maximum(size_new, size)
+            row, ids, both = row[possible], ids[possible], both[possible]
+            jac = 1.0 * both / (size_new[possible] + size[possible] - both)
+            similar = jac > self.graph['weight_floor']
+            id_new, id_c, jac = new_ids[row[similar]], ids[similar], jac[similar]
         else:
-            newnode = np.arange(max(self.nodes()) +1, max(self.nodes()) +1 + len(new_clusters))
-        resolution_graph.nodes[resname_new]['node_indices'] = newnode
+            id_new, id_c, jac = self._compare_window(resolution_graph, resname_new, new_ids)
+        row, col = self.add_edges(id_new, id_c, jac)
+        # the weights of the added edges are the last ones stored
+        strong = self._edge_weight.array[len(self._edge_weight) - len(row):] > np.float32(self.graph['sim_threshold'])
+        return row[strong], col[strong]
+
+    def _compare_buckets(self, new_ids):
+        # the stored clusters sharing the bucket of a band with a new cluster, the new ones included
+        row, col = [], []
+        for buckets, keys in zip(self._buckets, self._band_keys(self.signatures(new_ids)).T.tolist()):
+            for i, key in zip(new_ids.tolist(), keys):
+                ids = buckets[key]
+                row.extend([i] * len(ids))
+                col.extend(ids)
+        row, col = np.asarray(row, dtype=np.int64), np.asarray(col, dtype=np.int64)
+        keys = np.unique(np.minimum(row, col) << 32 | np.maximum(row, col))
+        row, col = keys >> 32, keys & 0xFFFFFFFF
+        kept = (row != col) & ~self._removed.array[row] & ~self._removed.array[col]
+        row, col = row[kept], col[kept]
+        jac = self.jaccard(row, col)
+        similar = jac > self.graph['weight_floor']
+        return row[similar], col[similar], jac[similar]
+
+    def _compare_window(self, resolution_graph, resname_new, new_ids):
+        other_ids = [resolution_graph.nodes[r]['node_indices'] for r in resolution_graph.neighbors(resname_new)
+                     if r != resname_new]
+        candidates = np.unique(np.concatenate([new_ids] + other_ids))
+        candidates = candidates[~self._removed.array[candidates]]
+        id_new, id_c, jac = jaccard_matrix(self.membership_matrix(new_ids), self.membership_matrix(candidates),
+                                           self.graph['weight_floor'], return_values=True)
+        return new_ids[id_new], candidates[id_c], jac
+
+    def remove_nodes_from(self, ids):
+        '''
+        remove clusters, together with their edges and members; the ids of the other clusters do not change
+        :param ids: cluster ids
+        '''
+        ids = np.unique(np.asarray(ids, dtype=np.int64))
+        ids = ids[~self._removed.array[ids]]
+        if len(ids) == 0:
+            return
+        for i in ids.tolist():
+            self._lookup[_members_key(self.members(i))].remove(i)
+        # removing isolated clusters does not split a component; otherwise the components are found again
+        isolated = not np.any(self.degrees()[ids])
+        self._removed.array[ids] = True
+        self._n_removed += len(ids)
+        if isolated:
+            self._component_size.array[ids] = 0
+        else:
+            self._rebuild_components()
+        indptr = self._indptr.array
+        self._n_dead += int(np.sum(indptr[ids + 1] - indptr[ids]))
+
+        # the stores are only rebuilt once the removed clusters take a large part of them
+        if self._n_dead > 0.5 * len(self._indices):
+            self.compact()
+
+    def compact(self):
+        '''drop the members and edges of the removed clusters from the stores; the stores are rebuilt in one pass'''
+        indptr = self._indptr.array
+        sizes = np.diff(indptr)
+        indices = self._indices.array[np.repeat(~self._removed.array, sizes)]
+        sizes[self._removed.array] = 0
+        self._indices = GrowableArray(np.int32, len(indices))
+        self._indices.extend(indices)
+        indptr[1:] = np.cumsum(sizes)
+        self._n_dead = 0
+
+        row, col, weight = self.edges(self.graph['weight_floor'], weight=True)
+        self._edge_row, self._edge_col = GrowableArray(np.int32, len(row)), GrowableArray(np.int32, len(col))
+        self._edge_weight = GrowableArray(np.float32, len(weight))
+        self._edge_keys = []
+        self.add_edges(row, col, weight)
+
+        if self._index_blocks:
+            self._index_blocks = []
+            self._index(self.nodes())
+
+    def component_sizes(self):
+        '''
+        :return: the component label of each cluster id (the id of the root of its component), and the size of each
+        component by label, i.e. the number of times its clusters were found (removed clusters do not count)
+        '''
+        return self._roots(), self._component_size.array.copy()
 
-        # compare against all other resolutions within range
-        newedges = []
-        for r in resolution_graph.neighbors(resname_new):
-            if r == resname_new: # itself
-                continue
-            r_node_ids = resolution_graph.nodes[r]['node_indices']
-            rmat = resolution_graph.nodes[r]['matrix']
-            id_new, id_r= jaccard_matrix(new_mat, rmat, self.graph['sim_threshold'])
-            if len(id_new) > 0:
-                id_new =  newnode[id_new]
-                id_r = r_node_ids[id_r]
-                for i in range(len(id_new)):
-                    newedges.append((id_new[i], id_r[i]))
-
-        # print('add {:d} new edges'.format(len(newedges)))
-        # for ni, i, s in newedges:
-        self.add_edges_from(newedges)
-
-        for nci in range(len(new_clusters)):
-            nc = new_clusters[nci]
-            ni = newnode[nci]
-            if not ni in self.nodes:
-                self.add_node(ni)
-            self.nodes[ni]['data'] = nc # is it a pointer?
-            # self.nodes[ni]['data'].index = ni
+    def degrees(self, threshold=None):
+        '''
+        :param threshold: count the edges with a Jaccard index above this value; None for sim_threshold
+        :return: number of edges of each cluster id (0 for the removed clusters)
+        '''
+        row, col = self.edges(threshold)
+        n = len(self._resolution)
+        return np.bincount(row, minlength=n) + np.bincount(col, minlength=n)
+
+    def prune(self, k, settled, keep_members=False):
+        '''
+        remove the clusters that can no longer be part of a component of k clusters (see consensus): isolated
+        clusters found fewer than k times, near whose resolutions no more resolutions will be sampled
+        :param k: minimum size of the components kept by consensus
+        :param settled: a function that takes the lowest and highest resolutions of clusters, and tells for each of
+        them whether no more resolutions will be sampled close to them
+        :param keep_members: keep the members of the removed clusters (see pruned_members), so that the partitions of
+        their resolutions can still be rebuilt
+        :return: the number of removed clusters
+        '''
+        # isolated even at the lowest threshold the graph can be viewed at
+        ids = np.flatnonzero(~self._removed.array & (self.degrees(self.graph['weight_floor']) == 0) &
+                             (self._count.array < k))
+        if len(ids) > 0:
+            ids = ids[settled(self._res_min.array[ids], self._res_max.array[ids])]
+            for i in ids.tolist():
+                self._pruned[_members_key(self.members(i))] = (self._count.array[i], self._res_min.array[i],
+                                                               self._res_max.array[i])
+                if keep_members:
+                    self._pruned_members[i] = self.members(i).copy()
+            self.remove_nodes_from(ids)
+        return len(ids)
 
     def remove_clusters(self, k, coherence=0.5):
         '''
@@ -108,13 +644,29 @@ class ClusterGraph(nx.Graph): # inherit networkx digraph
         '''
         # find a k-core of the cluster graph
         nodes_to_remove = []
-        core_numbers = nx.core_number(self)
+        core_numbers = nx.core_number(self.to_networkx(data=False))
         for i, v in core_numbers.items():
-            clust = self.nodes[i]['data']
-            if clust.padded and v < coherence*k:
+            if self._padded.array[i] and v < coherence*k:
                 nodes_to_remove.append(i)
         self.remove_nodes_from(nodes_to_remove)
 
+    def to_networkx(self, data=True):
+        '''
+        export the cluster graph as a networkx.Graph, in which each node has a Cluster object as attribute 'data'
+        :param data: if False, do not build the Cluster objects
+        :return: networkx.Graph
+        '''
+        G = nx.Graph()
+        G.graph.update(self.graph)
+        for i in self.nodes():
+            if data:
+                G.add_node(i, data=self.cluster(i))
+            else:
+                G.add_node(i)
+        row, col, weight = self.edges(weight=True)
+        G.add_weighted_edges_from(zip(row.tolist(), col.tolist(), weight.tolist()))
+        return G
+
     # def update_padding(self, newly_padded_resolution):
     #     '''
     #     deprecated
@@ -126,122 +678,702 @@ class ClusterGraph(nx.Graph): # inherit networkx digraph
     #         if clust.resolution_parameter in newly_padded_resolution:
     #             clust.padded = True
 
-def jaccard_matrix(matA, matB, threshold=0.75, prefilter = False): # assume matA, matB are sorted
+def _members_key(members):
+    '''key of a cluster in the lookup tables of ClusterGraph: its size and a 128-bit hash of its (int32) member indices'''
+    return len(members), hashlib.blake2b(members.tobytes(), digest_size=16).digest()
+
+def _size_bound_ranges(sizeA, sizeB, threshold):
+    '''the order that sorts sizeB, and for each cluster of A the range of the sorted sizes allowed by the size bound'''
+    order = np.argsort(sizeB, kind='stable')
+    sorted_sizes = sizeB[order]
+    # sizeB in (threshold * sizeA, sizeA / threshold); slightly widened against rounding, as pairs are checked anyway
+    with np.errstate(divide='ignore'):
+        lo = np.searchsorted(sorted_sizes, threshold * sizeA * (1 - 1e-9), side='right')
+        hi = np.searchsorted(sorted_sizes, sizeA / threshold * (1 + 1e-9), side='left') if threshold > 0 else \
+            np.full(len(sizeA), len(sizeB))
+    return order, lo, np.maximum(hi, lo)
+
+def size_bound_work(sizeA, sizeB, threshold=0.75):
+    '''
+    number of members that comparing the pairs of size_bound_pairs one by one would read, computed from the ranges of
+    sizes only (without building the pairs)
+    :param sizeA: sizes of a set of clusters
+    :param sizeB: sizes of another set of clusters
+    :param threshold: a Jaccard similarity cutoff
+    :return: an integer
+    '''
+    sizeA, sizeB = np.asarray(sizeA, dtype=np.int64), np.asarray(sizeB, dtype=np.int64)
+    order, lo, hi = _size_bound_ranges(sizeA, sizeB, threshold)
+    cumulative = np.zeros(len(sizeB) + 1, dtype=np.int64)
+    np.cumsum(sizeB[order], out=cumulative[1:])
+    return int(np.dot(hi - lo, sizeA) + np.sum(cumulative[hi] - cumulative[lo]))
+
+def size_bound_pairs(sizeA, sizeB, threshold=0.75):
+    '''
+    pairs of clusters whose sizes allow a Jaccard index above threshold (the Jaccard index is at most min/max of the
+    sizes), found by sorting sizeB and searching the size range of each cluster of A in it
+    :param sizeA: sizes of a set of clusters
+    :param sizeB: sizes of another set of clusters
+    :param threshold: a Jaccard similarity cutoff
+    :return: two arrays of indices, ordered by the index in A then the index in B
+    '''
+    sizeA, sizeB = np.asarray(sizeA), np.asarray(sizeB)
+    order, lo, hi = _size_bound_ranges(sizeA, sizeB, threshold)
+    counts = hi - lo
+    starts = np.zeros(len(sizeA), dtype=np.int64)
+    np.cumsum(counts[:-1], out=starts[1:])
+    idA = np.repeat(np.arange(len(sizeA)), counts)
+    idB = order[np.repeat(lo - starts, counts) + np.arange(len(idA))]
+    sort = np.lexsort((idB, idA))
+    return idA[sort], idB[sort]
+
+def jaccard_pairs(matA, matB, idA, idB):
+    '''
+    calculate the Jaccard index of given pairs of clusters, one overlap per pair
+    :param matA: scipy.sparse.csr_matrix, axis 0 for clusters, axis 1 for nodes in network
+    :param matB: similar to matA
+    :param idA: indices of clusters in matA
+    :param idB: indices of clusters in matB, one per index of idA
+    :return: the Jaccard index of each pair
+    '''
+    matA, matB = matA.astype(np.int32), matB.astype(np.int32)
+    sizeA, sizeB = matA.getnnz(axis=1)[idA], matB.getnnz(axis=1)[idB]
+    if len(idA) == 0:
+        return np.zeros(0)
+    both = np.asarray(matA[idA].multiply(matB[idB]).sum(axis=1)).ravel()
+    return 1.0 * both / (sizeA + sizeB - both)
+
+# the hash functions of MinHash are (a * x + b) mod MINHASH_PRIME, for node indices x below this (Mersenne) prime
+MINHASH_PRIME = (1 << 31) - 1
+
+def minhash_signatures(matrix, num_perm=128, seed=0):
+    '''
+    MinHash signatures of clusters: two signatures agree at a position with a probability equal to the Jaccard index of
+    the clusters
+    :param matrix: scipy.sparse.csr_matrix, axis 0 for clusters, axis 1 for nodes in network
+    :param num_perm: number of hash functions, i.e. length of the signatures
+    :param seed: seed of the hash functions; signatures are only comparable with the same seed
+    :return: numpy array (clusters x num_perm) of uint32; the signatures of empty clusters are MINHASH_PRIME
+    '''
+    matrix = matrix.tocsr()
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, MINHASH_PRIME, size=num_perm).astype(np.uint64)
+    b = rng.randint(0, MINHASH_PRIME, size=num_perm).astype(np.uint64)
+    signatures = np.full((matrix.shape[0], num_perm), MINHASH_PRIME, dtype=np.uint32)
+    nonempty = np.diff(matrix.indptr) > 0
+    if not np.any(nonempty):
+        return signatures
+    x = matrix.indices.astype(np.uint64)[:, np.newaxis]
+    starts = matrix.indptr[:-1][nonempty]
+    # 16 hash functions at a time, to bound the memory of the hashed members
+    for j in range(0, num_perm, 16):
+        hashed = (x * a[j:j + 16] + b[j:j + 16]) % np.uint64(MINHASH_PRIME)
+        signatures[nonempty, j:j + 16] = np.minimum.reduceat(hashed, starts, axis=0)
+    return signatures
+
+def lsh_bands(threshold, num_perm=128, recall=0.95):
+    '''
+    banding of MinHash signatures for locality-sensitive hashing: two clusters are compared if their signatures agree on
+    all the rows of one of the bands, which happens with a probability of 1 - (1 - s^rows)^bands for a Jaccard index s
+    :param threshold: a Jaccard similarity cutoff
+    :param num_perm: length of the signatures
+    :param recall: the probability with which two clusters with a Jaccard index at threshold must be compared
+    :return: the number of bands and the number of rows per band; as many rows as recall allows, so that the fewest
+    dissimilar clusters are compared
+    '''
+    for rows in range(num_perm, 0, -1):
+        bands = num_perm // rows
+        if 1 - (1 - threshold ** rows) ** bands >= recall:
+            return bands, rows
+    return num_perm, 1
+
+def lsh_keys(signatures, bands, rows):
+    '''
+    :param signatures: MinHash signatures, one row per cluster
+    :param bands: number of bands
+    :param rows: number of rows per band
+    :return: numpy array (clusters x bands) of uint64, a hash of each band of each signature
+    '''
+    signatures = signatures[:, :bands * rows].astype(np.uint64).reshape(len(signatures), bands, rows)
+    keys = np.zeros((len(signatures), bands), dtype=np.uint64)
+    for r in range(rows):
+        # (wraps around modulo 2^64)
+        keys = keys * np.uint64(1099511628211) ^ signatures[:, :, r]
+    return keys
+
+def lsh_pairs(keys):
+    '''
+    candidate pairs of clusters: the clusters that share the key of a band
+    :param keys: output of lsh_keys
+    :return: two arrays of indices (i < j), each pair once
+    '''
+    pairs = [np.zeros(0, dtype=np.int64)]
+    for band in keys.T:
+        order = np.argsort(band, kind='stable')
+        sorted_keys = band[order]
+        # each position is paired with the positions before it in its run of equal keys
+        starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+        run_start = np.repeat(starts, np.diff(np.r_[starts, len(band)]))
+        before = np.arange(len(band)) - run_start
+        offsets = np.arange(np.sum(before)) - np.repeat(np.cumsum(before) - before, before)
+        i, j = order[np.repeat(np.arange(len(band)), before)], order[np.repeat(run_start, before) + offsets]
+        pairs.append(np.minimum(i, j).astype(np.int64) << 32 | np.maximum(i, j))
+    pairs = np.unique(np.concatenate(pairs))
+    return pairs >> 32, pairs & 0xFFFFFFFF
+
+def minhash_jaccard(matrix, signatures, threshold=0.75, recall=0.95):
+    '''
+    approximate version of jaccard_matrix(matrix, matrix): only the pairs of clusters found by locality-sensitive
+    hashing of their MinHash signatures are compared (exactly)
+    :param matrix: scipy.sparse.csr_matrix, axis 0 for clusters, axis 1 for nodes in network
+    :param signatures: MinHash signatures of the clusters (see minhash_signatures)
+    :param threshold: a Jaccard similarity cutoff
+    :param recall: see lsh_bands
+    :return: two sets of indices (i < j); the cluster pairs implied by those indices satisfied threshold
+    '''
+    bands, rows = lsh_bands(threshold, signatures.shape[1], recall)
+    idA, idB = lsh_pairs(lsh_keys(signatures, bands, rows))
+    kept = jaccard_pairs(matrix, matrix, idA, idB) > threshold
+    return idA[kept], idB[kept]
+
+def jaccard_matrix(matA, matB, threshold=0.75, prefilter=None, return_values=False): # assume matA, matB are sorted
     '''
     calculate jaccard matrix between all pairs between two sets of clusters
     :param matA: scipy.sparse.csr_matrix, axis 0 for clusters, axis 1 for nodes in network
     :param matB: similar to matA; cluster set under a different resolution parameter
     :param threshold: a Jaccard similarity cutoff
-    :param prefilter: pre-filter the pairs to compare with a lower bound (didn't seem to speed up much)
-    :return: two sets of indices; the cluster pairs implied by those indices satisfied threshold
-    '''
-    if prefilter: # does not have much speed advantage
-        sizeA = np.ravel(np.asarray(np.sum(matA, axis=1)))
-        sizeB = np.ravel(np.asarray(np.sum(matB, axis=1)))
-        idA, idB = [], []
-        for i in range(len(sizeA)):
-            for j in range(len(sizeB)):
-                if 1.0 * min(sizeA[i], sizeB[j])/max(sizeA[i], sizeB[j]) < threshold:
-                    continue
-                else:
-                    idA.append(i)
-                    idB.append(j)
-        if len(idA) > 0:
-            idA = np.array(idA)
-            idB = np.array(idB)
-            # print(idA, idB)
-            matAs, matBs = matA[idA, :], matB[idB, :]
-            both = np.sum(matAs.multiply(matBs), axis=1).ravel()
-            either = matAs.getnnz(axis=1) + matBs.getnnz(axis=1) - both
-            # print(both.shape, matAs.getnnz(axis=1).shape,matBs.getnnz(axis=1).shape, np.min(either))
-            jac = 1.0*both/either
-            small_index = np.where(jac > threshold)
-            # print(small_index)
-            real_index = (idA[small_index[1]], idB[small_index[1]])
-            return real_index
-        else:
-            return ([], [])
+    :param prefilter: only compare the pairs whose sizes allow a Jaccard index above threshold, one overlap per pair,
+    instead of the overlapping pairs with one sparse matrix product. None for the product, unless the sizes allow no
+    pair at all (the only case where the prefilter won in benchmarks/jaccard_prefilter.py)
+    :param return_values: also return the Jaccard index of each pair
+    :return: two sets of indices; the cluster pairs implied by those indices satisfied threshold (and their Jaccard indices)
+    '''
+    # membership matrices are boolean; count overlaps as integers
+    matA, matB = matA.astype(np.int32), matB.astype(np.int32)
+    sizeA, sizeB = matA.getnnz(axis=1), matB.getnnz(axis=1)
+    if prefilter is None:
+        # a sort of the sizes, much cheaper than the product
+        _, lo, hi = _size_bound_ranges(sizeA, sizeB, threshold)
+        if np.all(hi == lo):
+            index = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+            return index + (np.zeros(0),) if return_values else index
+    if prefilter:
+        idA, idB = size_bound_pairs(sizeA, sizeB, threshold)
+        jac = jaccard_pairs(matA, matB, idA, idB)
+        kept = jac > threshold
+        index = (idA[kept], idB[kept])
+        if return_values:
+            return index + (jac[kept],)
+        return index
     else:
-        both = matA.dot(matB.T)
-
-        either = (np.tile(matA.getnnz(axis=1), (matB.shape[0],1)) + matB.getnnz(axis=1)[:, np.newaxis]).T -both
-        jac = 1.0*both/either
-        index = np.where(jac > threshold)
+        # only the pairs that overlap can pass the threshold: compute the Jaccard indices on the nonzeros of the sparse
+        # product, in the order of np.where on the full matrix
+        both = matA.dot(matB.T).tocsr()
+        both.sort_indices()
+        rows = np.repeat(np.arange(both.shape[0]), np.diff(both.indptr))
+        cols = both.indices
+        jac = 1.0 * both.data / (sizeA[rows] + sizeB[cols] - both.data)
+        kept = jac > threshold
+        index = (rows[kept], cols[kept])
+        if return_values:
+            return index + (jac[kept],)
         return index
 
 
-def run_alg(G, alg, gamma=1.0):
+class LeidenEngine(object):
+    '''
+    Leiden algorithm (RB configuration model) that keeps one leidenalg.Optimiser for a whole run, and reuses the
+    partition built on its graph (and thus the internal structures of leidenalg) across resolutions
+    '''
+    __slots__ = ['graph',
+                 'n_iterations',
+                 'optimiser',
+                 '_partition']
+
+    def __init__(self, G, n_iterations=2, seed=None):
+        '''initialize
+        G: the igraph graph that will be clustered at several resolutions
+        n_iterations: number of iterations of the Leiden algorithm; negative to iterate until the partition is stable
+        seed: seed of the random number generator of the optimiser
+         '''
+        self.graph = G
+        self.n_iterations = n_iterations
+        self.optimiser = leidenalg.Optimiser()
+        if seed is not None:
+            self.optimiser.set_rng_seed(seed)
+        self._partition = None
+
+    def optimise(self, gamma, G=None, seed=None, initial_membership=None, n_iterations=None):
+        '''
+        find a partition at a resolution
+        :param gamma: resolution parameter
+        :param G: the graph to cluster, e.g. a perturbed copy of the graph of the engine; None for the graph of the engine
+        :param seed: reseed the optimiser before optimising; None to continue with its current state
+        :param initial_membership: a membership vector to start from; None to start from singletons
+        :param n_iterations: overrides the number of iterations of the engine
+        :return: the partition (only valid until the next call), and the number of iterations that were run
+        '''
+        if seed is not None:
+            self.optimiser.set_rng_seed(seed)
+        if n_iterations is None:
+            n_iterations = self.n_iterations
+        if initial_membership is None:
+            initial_membership = range(self.graph.vcount() if G is None else G.vcount())
+
+        if G is None or G is self.graph:
+            if self._partition is None:
+                self._partition = leidenalg.RBConfigurationVertexPartition(self.graph, resolution_parameter=gamma)
+            partition = self._partition
+            partition.resolution_parameter = gamma
+            partition.set_membership(np.asarray(initial_membership).tolist())
+        else:
+            # edges differ, so only the optimiser can be reused
+            partition = leidenalg.RBConfigurationVertexPartition(G, initial_membership=np.asarray(initial_membership).tolist(),
+                                                                 resolution_parameter=gamma)
+        iteration = 0
+        while iteration < n_iterations or n_iterations < 0:
+            iteration += 1
+            # one iteration at a time (optimise_partition runs 2 by default), so that iterations are counted as in
+            # optimise_alg
+            if self.optimiser.optimise_partition(partition, n_iterations=1) <= 0:
+                break
+        return partition, iteration
+
+def run_alg(G, alg, gamma=1.0, seed=None):
     '''
     run community detection algorithm with resolution parameter. Right now only use RB in Louvain
     :param G: an igraph graph
+    :param alg: 'louvain', 'leiden', or a LeidenEngine (whose optimiser is reused)
     :param gamma: resolution parameter
+    :param seed: seed of the random number generator of the CD algorithm; None to leave it untouched
     :return: 
     '''
-    if alg =='louvain':
+    if isinstance(alg, LeidenEngine):
+        partition, _ = alg.optimise(gamma, G, seed)
+    elif alg =='louvain':
         partition_type = louvain.RBConfigurationVertexPartition
-        partition = louvain.find_partition(G, partition_type, resolution_parameter=gamma)
+        partition = louvain.find_partition(G, partition_type, resolution_parameter=gamma, seed=seed)
     elif alg == 'leiden':
-        partition_type = leidenalg.RBConfigurationVertexPartition
-        partition = leidenalg.RBConfigurationVertexPartition(G, partition_type, resolution_parameter=gamma)
+        partition, _ = LeidenEngine(G).optimise(gamma, seed=seed)
     # partition = sorted(partition, key=len, reverse=True)
     return partition
 
-def network_perturb(G, sample=0.8):
+def optimise_alg(G, alg, gamma=1.0, seed=None, initial_membership=None):
+    '''
+    run community detection algorithm with resolution parameter, repeating the optimiser until the partition stops improving
+    :param G: an igraph graph
+    :param alg: 'louvain', 'leiden', or a LeidenEngine
+    :param gamma: resolution parameter
+    :param seed: seed of the random number generator of the CD algorithm; None to leave it untouched
+    :param initial_membership: a membership vector to start the optimiser from; None to start from singletons
+    :return: the partition, and the number of optimiser iterations it took
+    '''
+    if alg == 'leiden':
+        alg = LeidenEngine(G)
+    if isinstance(alg, LeidenEngine):
+        return alg.optimise(gamma, G, seed, initial_membership, n_iterations=-1)
+    elif alg == 'louvain':
+        partition = louvain.RBConfigurationVertexPartition(G, initial_membership=initial_membership,
+                                                           resolution_parameter=gamma)
+        optimiser = louvain.Optimiser()
+        if seed is not None:
+            optimiser.set_rng_seed(seed)
+    n_iterations = 1
+    while optimiser.optimise_partition(partition) > 0:
+        n_iterations += 1
+    return partition, n_iterations
+
+def upper_triangle(A):
+    '''
+    the edges of an undirected network, each once
+    :param A: scipy.sparse matrix; symmetric, upper triangular or lower triangular adjacency matrix of the network
+    :return: scipy.sparse.coo_matrix, the upper triangle (with the diagonal) of A
+    '''
+    A = sp.sparse.csr_matrix(A)
+    if sp.sparse.tril(A, -1).nnz:
+        if sp.sparse.triu(A, 1).nnz == 0:
+            A = A.T
+        elif (A != A.T).nnz:
+            raise ValueError('adjacency matrix must be symmetric, or upper or lower triangular')
+    return sp.sparse.triu(A, format='coo')
+
+def adjacency_to_graph(A, names=None):
+    '''
+    convert an adjacency matrix to an undirected igraph graph, passing the edge arrays directly (no edge list file)
+    :param A: scipy.sparse matrix; symmetric, upper triangular or lower triangular adjacency matrix of the network
+    :param names: names of the nodes, in the order of the rows of A; stored as the 'name' attribute of the vertices
+    :return: an igraph graph; the entries of A are stored as the 'weight' attribute of the edges
+    '''
+    if A.shape[0] != A.shape[1]:
+        raise ValueError('adjacency matrix must be square, got shape %s' % (A.shape,))
+    if names is not None and len(names) != A.shape[0]:
+        raise ValueError('names size mismatch: %d instead of %d' % (len(names), A.shape[0]))
+    A = upper_triangle(A)
+    G = ig.Graph(n=A.shape[0], edges=np.column_stack((A.row, A.col)), directed=False)
+    G.es['weight'] = A.data
+    if names is not None:
+        G.vs['name'] = np.asarray(names).tolist()
+    return G
+
+def edge_arrays(G):
+    '''
+    the edges of a graph as arrays, from which network_perturb builds the perturbed graphs; compute them once per run
+    :param G: an igraph graph
+    :return: the number of nodes, the edges (array of m x 2 node indices), and their weights (None if not weighted)
+    '''
+    edges = np.array(G.get_edgelist(), dtype=np.int64).reshape(-1, 2)
+    weights = np.asarray(G.es['weight']) if 'weight' in G.es.attributes() else None
+    return G.vcount(), edges, weights
+
+def network_perturb(G, sample=0.8, seed=None, names=None, edges=None):
     '''
     perturb the network by randomly deleting some edges
-    :param G: input network
+    :param G: input network; an igraph graph, or a scipy.sparse adjacency matrix
     :param sample: the fraction of edges to retain
-    :return: the perturbed graph
+    :param seed: seed of the random number generator, or a numpy.random.Generator; None to use fresh entropy
+    :param names: names of the nodes if G is an adjacency matrix (see adjacency_to_graph)
+    :param edges: the output of edge_arrays(G) if G is an igraph graph; None to compute it
+    :return: the perturbed graph (without the attributes of G, except the weights of the edges)
+    '''
+    rng = np.random.default_rng(seed)
+    if sp.sparse.issparse(G):
+        A = upper_triangle(G)
+        kept_edges = rng.random(A.nnz) <= sample
+        A = sp.sparse.coo_matrix((A.data[kept_edges], (A.row[kept_edges], A.col[kept_edges])), shape=A.shape)
+        return adjacency_to_graph(A, names)
+    n, edges, weights = edge_arrays(G) if edges is None else edges
+    kept_edges = rng.random(len(edges)) <= sample
+    # build the perturbed graph from the kept edges only, instead of copying G and deleting the other edges
+    return ig.Graph(n, edges=edges[kept_edges], directed=False,
+                    edge_attrs={} if weights is None else {'weight': weights[kept_edges]})
+
+def resolution_seed(seed, gamma, replicate=0):
+    '''
+    derive a deterministic seed for a single resolution, so that the result of a resolution does not depend on
+    the order (or the process) in which it is visited
+    :param seed: the seed of the whole run
+    :param gamma: resolution parameter
+    :param replicate: index of the perturbed replicate at this resolution
+    :return: an integer seed
+    '''
+    key = repr(float(gamma))
+    if replicate:
+        key += '/{:d}'.format(replicate)
+    return (seed + zlib.crc32(key.encode())) % (2**31 - 1)
+
+def sample_resolution(G, alg, gamma, sample=1.0, seed=None, warm_start=False, initial_membership=None, edges=None):
     '''
-    G1 = G.copy()
-    edges_to_remove = [e.index for e in G1.es if np.random.rand() > sample]
-    G1.delete_edges(edges_to_remove)
-    return G1
+    run the CD algorithm once at a given resolution, on a perturbed network if sample < 1
+    :param G: input network
+    :param alg: 'louvain', 'leiden', or a LeidenEngine
+    :param gamma: resolution parameter
+    :param sample: parameter to perturb input network by deleting edges
+    :param seed: seed for both the perturbation and the CD algorithm
+    :param warm_start: if True, optimise until convergence (see optimise_alg) and count the optimiser iterations
+    :param initial_membership: membership vector to start from in the warm start mode; None for a cold start
+    :param edges: the output of edge_arrays(G), to perturb the network; None to compute it
+    :return: membership matrix, number of clusters, total weight in all communities, number of optimiser iterations (None if not warm_start)
+    '''
+    if sample < 1:
+        G = network_perturb(G, sample, seed, edges=edges)
+    if warm_start:
+        partition, n_iterations = optimise_alg(G, alg, gamma, seed, initial_membership)
+    else:
+        partition, n_iterations = run_alg(G, alg, gamma, seed), None
+    return partition_to_membership_matrix(partition), len(partition), partition.total_weight_in_all_comms(), n_iterations
+
+_WORKER = {}
+
+def _init_worker(G, alg, sample, warm_start, n_iterations=2):
+    # keep the network in the worker process, so it is only pickled once per worker
+    if alg == 'leiden':
+        alg = LeidenEngine(G, n_iterations)
+    _WORKER['args'] = (G, alg)
+    _WORKER['edges'] = edge_arrays(G) if sample < 1 else None
+    _WORKER['sample'] = sample
+    _WORKER['warm_start'] = warm_start
+
+def _sample_worker(task):
+    gamma, seed, initial_membership = task
+    G, alg = _WORKER['args']
+    cd_start = time.time()
+    result = sample_resolution(G, alg, gamma, _WORKER['sample'], seed, _WORKER['warm_start'], initial_membership,
+                             _WORKER['edges'])
+    return result, time.time() - cd_start
 
 def partition_to_membership_matrix(partition, minsize=4):
     '''
     
-    :param partition: class partition in the louvain-igraph package
+    :param partition: class partition in the louvain-igraph package, or a membership vector
     :param minsize: minimum size of clusters; smaller clusters will be deleted afterwards 
-    :return: 
+    :return: scipy.sparse.csr_matrix (boolean), one row per cluster ordered by size (descending), one column per node
     '''
-    clusters = sorted([p for p in partition if len(p) >=minsize], key=len, reverse=True)
-    row, col = [], []
-    for i in range(len(clusters)):
-        row.extend([i for _ in clusters[i]])
-        col.extend([x for x in clusters[i]])
-    row = np.array(row)
-    col = np.array(col)
-    data = np.ones_like(row, dtype=int)
-    C = sp.sparse.coo_matrix((data, (row, col)), shape=(len(clusters), partition.n)) # TODO: make it not dependent on partition.n
-    C = C.tocsr()
+    membership = np.asarray(getattr(partition, 'membership', partition))
+    n = len(membership)
+    sizes = np.bincount(membership)
+    clusters = np.argsort(-sizes, kind='stable') # ties keep the order of the labels, as sorted() did
+    clusters = clusters[sizes[clusters] >= minsize]
+    rank = -np.ones(len(sizes), dtype=np.int32)
+    rank[clusters] = np.arange(len(clusters), dtype=np.int32)
+    row = rank[membership]
+    members = np.flatnonzero(row >= 0)
+    members = members[np.argsort(row[members], kind='stable')].astype(np.int32)
+    indptr = np.zeros(len(clusters) + 1, dtype=np.int32)
+    np.cumsum(sizes[clusters], out=indptr[1:])
+    C = sp.sparse.csr_matrix((np.ones(len(members), dtype=bool), members, indptr), shape=(len(clusters), n))
     return C
 
+def membership_matrix_to_membership(matrix):
+    '''
+    convert a membership matrix back to a membership vector; nodes that are in none of the clusters
+    (e.g. members of clusters smaller than minsize) become singletons
+    :param matrix: scipy.sparse.csr_matrix, axis 0 for clusters, axis 1 for nodes in network
+    :return: a membership vector with consecutive labels
+    '''
+    n_clusters, n = matrix.shape
+    membership = -np.ones(n, dtype=int)
+    membership[matrix.indices] = np.repeat(np.arange(n_clusters), np.diff(matrix.indptr))
+    singletons = membership < 0
+    membership[singletons] = np.arange(n_clusters, n_clusters + np.count_nonzero(singletons))
+    return membership
+
+def variation_of_information(membership1, membership2):
+    '''
+    variation of information between two partitions, normalized by log(n) to lie in [0, 1]
+    :param membership1: a membership vector
+    :param membership2: a membership vector of the same nodes
+    :return: 0 for identical partitions, 1 for the partition into singletons against the one into a single cluster
+    '''
+    n = len(membership1)
+    if n < 2:
+        return 0.0
+    _, x = np.unique(membership1, return_inverse=True)
+    _, y = np.unique(membership2, return_inverse=True)
+    _, joint = np.unique(x.astype(np.int64) * (y.max() + 1) + y, return_counts=True)
+    entropy = lambda counts: -np.sum(counts / n * np.log(counts / n))
+    vi = 2 * entropy(joint) - entropy(np.bincount(x)) - entropy(np.bincount(y))
+    return max(vi, 0.0) / np.log(n)
+
+def resolution_membership(cluG, resolution_node, replicate=0):
+    '''
+    rebuild the partition found at a visited resolution from the cluster graph; nodes that are in none of its clusters
+    (too small, or removed, or pruned without keeping their members) are singletons
+    :param cluG: the ClusterGraph
+    :param resolution_node: the attributes of a visited resolution in the ResolutionGraph
+    :param replicate: index of the replicate; replicate 0 is used if the resolution does not have this one
+    :return: a membership vector
+    '''
+    replicates = resolution_node['replicates']
+    rows = replicates == (replicate if np.any(replicates == replicate) else 0)
+    ids = resolution_node['node_indices'][rows]
+    removed = cluG._removed.array[ids]
+    if not np.any(removed):
+        return membership_matrix_to_membership(cluG.membership_matrix(ids))
+    # the members of pruned clusters are used if they were kept, so that the partition (and what depends on it) is the
+    # same as without pruning
+    members = [cluG.members(i) if not r else cluG.pruned_members(i) for i, r in zip(ids.tolist(), removed)]
+    members = [m for m in members if m is not None]
+    indptr = np.zeros(len(members) + 1, dtype=np.int64)
+    np.cumsum([len(m) for m in members], out=indptr[1:])
+    indices = np.concatenate(members) if members else np.zeros(0, dtype=np.int32)
+    matrix = sp.sparse.csr_matrix((np.ones(len(indices), dtype=bool), indices, indptr),
+                                  shape=(len(members), cluG.graph['num_leaves']))
+    return membership_matrix_to_membership(matrix)
+
+class ResolutionGraph(object):
+    '''
+    The "resolution graph": each node is a visited resolution (keyed by the exact float) with its attributes in
+    self.nodes, and edges connect resolutions that are close enough. The resolutions are also kept sorted by their
+    log value, so that the resolutions near a new one are found by bisection instead of scanning all of them
+    '''
+
+    def __init__(self):
+        self.nodes = {}
+        self._adj = {}
+        self._log_resolutions = [] # sorted
+        self._resolutions = [] # in the same order as _log_resolutions
+
+    def __len__(self):
+        return len(self._resolutions)
+
+    def __contains__(self, resolution):
+        return resolution in self.nodes
+
+    def __iter__(self):
+        return iter(self._resolutions)
+
+    def add_node(self, node, **attr):
+        node = float(node)
+        if node not in self.nodes:
+            i = bisect.bisect_left(self._log_resolutions, np.log10(node))
+            self._log_resolutions.insert(i, np.log10(node))
+            self._resolutions.insert(i, node)
+            self.nodes[node] = {}
+            self._adj[node] = []
+        self.nodes[node].update(attr)
+
+    def add_edge(self, u, v):
+        self._adj[u].append(v)
+        self._adj[v].append(u)
+
+    def neighbors(self, resolution):
+        return iter(self._adj[resolution])
 
-def update_resolution_graph(G, new_resolution, partition, value, neighborhood_size, neighbor_density_threshold):
+    def degree(self, resolution):
+        return len(self._adj[resolution])
+
+    def window(self, resolution, size):
+        '''
+        :param resolution: a resolution parameter
+        :param size: half width of the window in log10 scale
+        :return: the visited resolutions whose log10 differs from the one of resolution by less than size
+        '''
+        x = np.log10(resolution)
+        lo = bisect.bisect_right(self._log_resolutions, x - size)
+        hi = bisect.bisect_left(self._log_resolutions, x + size)
+        return self._resolutions[lo:hi]
+
+    def settled(self, low, high, size):
+        '''
+        :param low: an array of resolution parameters
+        :param high: an array of resolution parameters, not lower than low
+        :param size: half width of the neighborhood in log10 scale
+        :return: for each range [low, high], whether no more resolution can be sampled within size of it; that is, the
+        visited resolutions from the one before low - size to the one after high + size are all padded
+        '''
+        log_resolutions = np.asarray(self._log_resolutions)
+        unpadded = np.zeros(len(self._resolutions) + 1, dtype=int)
+        np.cumsum([not self.nodes[r]['padded'] for r in self._resolutions], out=unpadded[1:])
+        lo = np.maximum(np.searchsorted(log_resolutions, np.log10(low) - size, side='right') - 1, 0)
+        hi = np.minimum(np.searchsorted(log_resolutions, np.log10(high) + size, side='left') + 1, len(log_resolutions))
+        return unpadded[hi] == unpadded[lo]
+
+    def nearest(self, resolution):
+        '''
+        :param resolution: a resolution parameter
+        :return: the visited resolution closest (in log-scale) to resolution, or None if there is none
+        '''
+        x = np.log10(resolution)
+        i = bisect.bisect_left(self._log_resolutions, x)
+        candidates = [j for j in (i - 1, i) if 0 <= j < len(self._resolutions)]
+        if not candidates:
+            return None
+        j = min(candidates, key=lambda j: abs(self._log_resolutions[j] - x))
+        return self._resolutions[j]
+
+def iter_search_maxres(minres, n_minres, maxres, maxn, tolerance=0.2, maximum_probes=20):
+    '''
+    find the resolution at which the number of clusters is close to maxn, by a bracketing search that interpolates
+    the log number of clusters against the log resolution. The search starts from the guess maxres; the minimum
+    resolution only serves as a bracket end, and the returned resolution is always above it, so that the range between
+    them can be sampled. A generator that yields each resolution to probe, and takes its number of clusters back (send),
+    so that the caller can process each probe before the next one
+    :param minres: minimum resolution parameter
+    :param n_minres: number of clusters at minres
+    :param maxres: the initial guess of the maximum resolution parameter
+    :param maxn: the target number of clusters
+    :param tolerance: accept a resolution if its number of clusters is within this fraction of maxn
+    :param maximum_probes: upper limit of the number of probes
+    :return: the maximum resolution parameter, and whether the target was reached (returned when the generator stops)
+    '''
+    low, high = None, None # (log resolution, log number of clusters) of the bracket ends
+    floor = np.log(minres)
+    point = (floor, np.log(max(n_minres, 1)))
+    # minres is the lower bracket end if it has too few clusters; otherwise the target is reached above minres all the
+    # same (e.g. one cluster per component at minres), and the search only must not go down to minres
+    if n_minres < (1 - tolerance) * maxn:
+        low = point
+    visited = [point]
+
+    x, target = max(np.log(maxres), floor + np.log(2.0)), np.log(maxn)
+    best = (np.inf, None)
+    for _ in range(maximum_probes):
+        res = np.round(np.exp(x), 4)
+        if res <= minres and best[1] is not None:
+            break
+        n = yield res
+        best = min(best, (abs(np.log(max(n, 1)) - target), res))
+        if (1 - tolerance) * maxn <= n <= (1 + tolerance) * maxn:
+            return res, True
+        point = (np.log(res), np.log(max(n, 1)))
+        visited.append(point)
+        if n < (1 - tolerance) * maxn:
+            low = point if low is None or point[0] > low[0] else low
+        else:
+            high = point if high is None or point[0] < high[0] else high
+
+        if low is not None and high is not None:
+            # interpolate inside the bracket; stay away from the ends so that the bracket keeps shrinking
+            t = (target - low[1]) / (high[1] - low[1]) if high[1] > low[1] else 0.5
+            t = min(max(t, 0.1), 0.9)
+            x = low[0] + t * (high[0] - low[0])
+        else:
+            # extrapolate from the two points closest to the target side, moving at least 2x and at most 10x
+            end = low if high is None else high
+            direction = 1 if high is None else -1
+            others = [v for v in visited if v != end]
+            step = np.log(2.0)
+            if others:
+                other = min(others, key=lambda v: abs(v[0] - end[0]))
+                if end[0] != other[0]:
+                    slope = (end[1] - other[1]) / (end[0] - other[0])
+                    if slope > 0:
+                        step = abs(target - end[1]) / slope
+            x = end[0] + direction * min(max(step, np.log(2.0)), np.log(10.0))
+            if x <= floor:
+                # going down without a lower bracket end: halve the (log) distance to minres instead of reaching it
+                x = (floor + end[0]) / 2
+        if np.round(np.exp(x), 4) == res:
+            break
+    LOGGER.warning(
+        'Reach upper limit of initial resolution searching, cannot get the target number of cluster. The input network may be incompatible with the specified number of clusters ...')
+    # the closest probe; all of them are above minres
+    return best[1], False
+
+def search_maxres(probe, minres, n_minres, maxres, maxn, tolerance=0.2, maximum_probes=20):
+    '''
+    find the resolution at which the number of clusters is close to maxn (see iter_search_maxres)
+    :param probe: a function that runs the CD algorithm at a resolution and returns the number of clusters
+    (the other parameters are those of iter_search_maxres)
+    :return: the maximum resolution parameter, and whether the target was reached
+    '''
+    search = iter_search_maxres(minres, n_minres, maxres, maxn, tolerance, maximum_probes)
+    try:
+        res = next(search)
+        while True:
+            res = search.send(probe(res))
+    except StopIteration as stop:
+        return stop.value
+
+def update_resolution_graph(G, new_resolution, partition, value, neighborhood_size, neighbor_density_threshold, replicates=None):
     '''
     Update the "resolution graph", which connect resolutions that are close enough
-    :param G: nx.Graph; the "resolution graph"
+    :param G: ResolutionGraph; the "resolution graph"
     :param new_resolution: the resolution just visited by the CD algorithm 
-    :param partition: partition generated by 
+    :param partition: partition generated by the CD algorithm, or its membership matrix (the stacked matrices of all replicates)
     :param value: deprecated
     :param neighborhood_size: if two resolutions (log-scale) differs smaller than this value, they are called 'neighbors'
     :param neighbor_density_threshold: if a resolution has neighbors more than this number, it is called "padded". No more sampling will happen between two padded resolutions
-    :return: 
+    :param replicates: replicate index of each row of the membership matrix; None if there is only one replicate
+    :return: the resolutions that became padded
     '''
-    nodename = '{:.4f}'.format(new_resolution)
-    membership = partition_to_membership_matrix(partition)
+    nodename = float(new_resolution)
+    if sp.sparse.issparse(partition):
+        membership = partition
+    else:
+        membership = partition_to_membership_matrix(partition)
+    if replicates is None:
+        replicates = np.zeros(membership.shape[0], dtype=int)
+    neighbors = [] if nodename in G else G.window(nodename, neighborhood_size)
     G.add_node(nodename, resolution = new_resolution,
-               matrix=membership,
+               matrix=membership, replicates=np.asarray(replicates),
                padded=False, value=value)
-    for v, vd in G.nodes(data=True):
-        if v == nodename:
-            continue
-        if abs(np.log10(vd['resolution']) - np.log10(new_resolution)) < neighborhood_size:
-            G.add_edge(v, nodename)
+    for v in neighbors:
+        G.add_edge(v, nodename)
+    # only the degrees of the new resolution and its neighbors have changed
     newly_padded = []
-    for v, deg in G.degree():
-        if deg > neighbor_density_threshold:
+    for v in neighbors + [nodename]:
+        if G.degree(v) > neighbor_density_threshold:
             if not G.nodes[v]['padded']:
                 newly_padded.append(v)
             G.nodes[v]['padded'] = True
@@ -264,33 +1396,64 @@ def collapse_cluster_graph(cluG, components, threshold=100):
     '''
     take the cluster graph and collapse each component based on some consensus metric
     :param cluG: the ClusterGraph object
-    :param components: a list of list, each element of the inner list is a binary membership array
+    :param components: a list of list, each element of the inner list is a node of the cluster graph
     :param threshold: t; remove nodes if they did not appear in more than t percent of clusters in one component 
     '''
     collapsed_clusters = []
     for component in components:
-        clusters = [cluG.nodes[v]['data'].binary for v in component]
-        mat = np.stack(clusters)
-        participate_index = np.mean(mat, axis=0)
+        component = list(component)
+        mat = cluG.membership_matrix(component)
+        # a cluster that was found n times counts as n clusters
+        counts = cluG.counts(component)
+        participate_index = 1.0 * np.bincount(mat.indices, weights=np.repeat(counts, np.diff(mat.indptr)),
+                                              minlength=cluG.graph['num_leaves']) / np.sum(counts)
         threshold_met = participate_index *100 > threshold
         threshold_met = threshold_met.astype(int)
         collapsed_clusters.append(threshold_met)
     return collapsed_clusters
 
-def run(G,
-        density=0.1,
-        neighbors=10,
-        jaccard=0.75,
-        sample=0.9,
-        minres=0.01,
-        maxres=10,
-        alg='louvain',
-        maxn=None,
-        bisect=False):
+# what iter_run yields after each sampled resolution: the resolution, its membership matrix (the stacked matrices of
+# all replicates), the cluster id of each row of the matrix, the new edges of the cluster graph (two arrays of cluster
+# ids), the seconds since the start of the run, the seconds spent in the CD algorithm at this resolution (all
+# replicates), and the cluster graph itself (still growing)
+ResolutionEvent = namedtuple('ResolutionEvent', ['resolution', 'membership', 'node_indices', 'edges', 'elapsed',
+                                                 'cd_time', 'cluster_graph'])
+
+# number of extra runs of the CD algorithm from singletons, to estimate the saving of warm starts
+COLD_BASELINE_RUNS = 3
+
+def iter_run(G,
+             density=0.1,
+             neighbors=10,
+             jaccard=0.75,
+             sample=0.9,
+             minres=0.01,
+             maxres=10,
+             alg='louvain',
+             maxn=None,
+             bisect=False,
+             workers=1,
+             seed=None,
+             warm_start=False,
+             replicates=1,
+             n_iterations=2,
+             names=None,
+             prune=None,
+             patience=None,
+             k=5,
+             time_budget=None,
+             max_runs=None,
+             all_to_all=False,
+             weight_floor=0.5,
+             minhash=0,
+             recall=0.95):
     # other default parameters
     '''
-    Main function to run the Finder program
-    :param G: input network
+    Run the Finder program step by step; a generator that yields a ResolutionEvent after each sampled resolution, so
+    that the caller can persist or process the results while sampling goes on, or stop early (closing the generator
+    stops the workers). With workers > 1, the resolutions of a bisection level are yielded once the whole level is
+    sampled. Returns the ClusterGraph when sampling is finished
+    :param G: input network; an igraph graph, or a scipy.sparse adjacency matrix
     :param density: inversed density of sampling resolution parameter. Use a smaller value to increase sample density (will increase running time)
     :param neighbors: also affect sampling density; a larger value may have additional benefits of stabilizing clustering results
     :param jaccard: a cutoff to call two clusters similar
@@ -298,107 +1461,466 @@ def run(G,
     :param minres: minimum resolution parameter
     :param maxres: maximum resolution parameter
     :param maxn: will explore resolution parameter until cluster number is similar to this number; will override 'maxres'
-    :param bisect: if set to True, if solutions between two resolutions look similar, halt sampling in between. Could reduce stability a little
+    :param bisect: if set to True (or to a threshold), halt sampling between two resolutions whose partitions (replicate 0)
+    differ by a normalized variation of information below the threshold (0.01 for True), so that only the ranges where
+    the partition changes are subdivided. Could reduce stability a little
+    :param workers: number of processes to sample the resolutions of the same bisection level concurrently. The cluster graph does not depend on this number,
+    except with time_budget or max_runs, where each batch has one range per worker
+    :param seed: seed of the run; each resolution gets its own seed derived from it. None to draw one from the global numpy state
+    :param warm_start: if set to True, start the CD algorithm from the partition of the nearest visited resolution instead of singletons
+    :param replicates: number of perturbed runs of the CD algorithm at each sampled resolution; all of them are added to the cluster graph
+    :param n_iterations: number of iterations of the Leiden algorithm (alg='leiden'); negative to iterate until the partition is stable
+    :param names: names of the nodes if G is an adjacency matrix (see adjacency_to_graph)
+    :param prune: if set to a number k, remove during sampling the clusters that can no longer be part of a component of
+    k clusters, to bound the memory of the run; consensus with the same k is not affected. With warm_start, bisect or a
+    budget, the members of the pruned clusters are kept for the partitions of their resolutions, so that the sampling
+    is not affected either. None to keep all clusters
+    :param patience: stop sampling once this many consecutive bisection levels (batches of runs with a budget) found
+    neither a new cluster (one that is not similar to any cluster found before) nor a new component of at least k
+    clusters at any of their resolutions. None to sample until all ranges are padded
+    :param k: minimum size of the components watched by patience; use the k of consensus
+    :param time_budget: stop sampling after this many seconds (checked before each batch of runs), and return the cluster
+    graph of the resolutions visited so far. With a budget, the ranges are sampled one batch (one range per worker) at a
+    time, the ones over which the partition changes the most (log width times variation of information) first, instead
+    of level by level
+    :param max_runs: stop sampling after this many runs of the CD algorithm (counting the initial ones); like
+    time_budget, samples the most informative ranges first
+    :param all_to_all: compare each new cluster with all the clusters found so far (through an inverted index), instead
+    of only those of the resolutions within density. Disables prune
+    :param weight_floor: also keep the pairs of clusters with a Jaccard index between this value and jaccard, so that the
+    cluster graph can be viewed at a higher cutoff later (ClusterGraph.threshold) without running again
+    :param minhash: compare each new cluster with all the clusters found so far, approximately: only with those whose
+    MinHash signatures (of this length) share a band (see lsh_bands). Scales to very large cluster graphs; consensus
+    then uses the signatures too. Disables prune. 0 for exact comparisons
+    :param recall: with minhash, the probability that two clusters with a Jaccard index at weight_floor are compared
     :return: 
     '''
-    min_diff_bisect_value = 1
+    min_diff_vi = 0.01 if bisect is True else bisect
+    start_time = time.time()
     min_diff_resolution = 0.001
 
     # G = ig.Graph.Read_Ncol(G)
+    if sp.sparse.issparse(G):
+        G = adjacency_to_graph(G, names)
     G.simplify(multiple=False) # remove self loop but keep weight
-    cluG = ClusterGraph()
-    cluG.graph['sim_threshold'] = jaccard
-    cluG.graph['num_leaves'] = len(G.vs)
+    cluG = ClusterGraph(len(G.vs), jaccard, all_to_all, weight_floor, minhash, recall)
+    if (all_to_all or minhash) and prune is not None:
+        LOGGER.warning('Pruning is disabled with all_to_all or minhash: '
+                       'a cluster can be matched by any later resolution')
+        prune = None
+
+    resolution_graph = ResolutionGraph()
+
+    if seed is None:
+        seed = np.random.randint(2**31 - 1)
+
+    # the Leiden engine keeps its optimiser (and structures built on G) for the whole run
+    engine = LeidenEngine(G, n_iterations, seed) if alg == 'leiden' else alg
 
-    resolution_graph = nx.Graph()
+    # optimiser iterations of warm starts, and of cold starts at some of the same resolutions (the first of the first
+    # COLD_BASELINE_RUNS batches), to report the saving of warm_start
+    cold_iterations, warm_iterations = [], []
 
     # perform two initial louvain
-    minres_partition = run_alg(G, alg, minres)
+    cd_start = time.time()
+    minres_partition = sample_resolution(G, engine, minres, 1.0, resolution_seed(seed, minres), warm_start)
+    cd_time = time.time() - cd_start
 
     LOGGER.timeit('_resrange')
+    # the resolution graph still drives the sampling (padding), even if clusters are compared all-to-all
+    update_resolution_graph(resolution_graph, minres, minres_partition[0],
+                            minres_partition[2], density, neighbors)
+    edges = cluG.add_clusters(resolution_graph, minres)
+    yield ResolutionEvent(minres, minres_partition[0], resolution_graph.nodes[float(minres)]['node_indices'], edges,
+                          time.time() - start_time, cd_time, cluG)
+
+    n_clusters = {minres: minres_partition[1]}
+    def probe(res):
+        # every probe is kept as a sample of the multiresolution clustering
+        cd_start = time.time()
+        partition = sample_resolution(G, engine, res, 1.0, resolution_seed(seed, res), warm_start)
+        cd_time = time.time() - cd_start
+        LOGGER.info('Resolution:{:.4f}; find {} clusters'.format(res, partition[1]))
+        update_resolution_graph(resolution_graph, res, partition[0], partition[2], density, neighbors)
+        edges = cluG.add_clusters(resolution_graph, res)
+        n_clusters[res] = partition[1]
+        return ResolutionEvent(res, partition[0], resolution_graph.nodes[float(res)]['node_indices'], edges,
+                               time.time() - start_time, cd_time, cluG)
+
     LOGGER.info('Finding maximum resolution...')
+    # each probe is yielded as soon as it is done
     if maxn != None:
-        next= True
-        last_move = ''
-        last_res = maxres
-        maximum_while_loop = 20
-        n_loop = 0
-        while next==True:
-            test_partition = run_alg(G, alg, maxres)
-            n_loop += 1
-            if n_loop > maximum_while_loop:
-                LOGGER.warning(
-                    'Reach upper limit of initial resolution searching, cannot get the target number of cluster. The input network may be incompatible with the specified number of clusters ...')
-                break
-            # print(len(test_partition))
-            if len(test_partition) < 0.8*maxn:
-                if last_move == 'down':
-                    maxres = np.sqrt(maxres*last_res)
-                else:
-                    maxres = maxres*2.0
-                last_move = 'up'
-            elif len(test_partition) > 1.2*maxn:
-                if last_move == 'up':
-                    maxres = np.sqrt(maxres*last_res)
-                else:
-                    maxres = maxres/2.0
-                last_move = 'down'
-            else:
-                next=False
-        maxres_partition = test_partition
-    else:
-        maxres_partition = run_alg(G, alg, maxres)
-    stack_res_range = []
-    LOGGER.info('Lower bound of resolution parameter: {:.4f}; with {:d} clusters'.format(minres, len(minres_partition)))
-    LOGGER.info('Upper bound of resolution parameter: {:.4f}; with {:d} clusters'.format(maxres, len(maxres_partition)))
-    stack_res_range.append((minres, maxres))
-
-    # TODO: resolution graph won't be needed. will be able to perform all-to-all comparison
-    update_resolution_graph(resolution_graph, minres, minres_partition,
-                            minres_partition.total_weight_in_all_comms(), density, neighbors)
-    update_resolution_graph(resolution_graph, maxres, maxres_partition,
-                            maxres_partition.total_weight_in_all_comms(), density, neighbors)
-    cluG.add_clusters(resolution_graph, minres)
-    cluG.add_clusters(resolution_graph, maxres)
+        search = iter_search_maxres(minres, minres_partition[1], maxres, maxn)
+        try:
+            res = next(search)
+            while True:
+                if res not in n_clusters:
+                    yield probe(res)
+                res = search.send(n_clusters[res])
+        except StopIteration as stop:
+            maxres, _ = stop.value
+    elif maxres not in n_clusters:
+        yield probe(maxres)
+    LOGGER.info('Lower bound of resolution parameter: {:.4f}; with {:d} clusters'.format(minres, n_clusters[minres]))
+    LOGGER.info('Upper bound of resolution parameter: {:.4f}; with {:d} clusters'.format(maxres, n_clusters[maxres]))
+
+    # bisect between the consecutive resolutions visited so far
+    visited = sorted(res for res in n_clusters if minres <= res <= maxres)
+    stack_res_range = list(zip(visited[:-1], visited[1:]))
     LOGGER.report('Resolution range initialized in %.2fs', '_resrange')
 
-
-    LOGGER.timeit('_sample')
-    while stack_res_range:
-        current_range = stack_res_range.pop(0)
-        resname1, resname2 = '{:.4f}'.format(current_range[0]), '{:.4f}'.format(current_range[1])
-        # LOGGER.debug('Current resolution range:{} {}'.format(resname1, resname2))
-
-        if round(current_range[1] - current_range[0], 4) <= min_diff_resolution:
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(G, alg, sample, warm_start, n_iterations))
+    # the edges from which the perturbed networks are built (the workers compute their own)
+    edges = edge_arrays(G) if sample < 1 and pool is None else None
+
+    def run_task(task):
+        # a run of the CD algorithm without workers, and its time in seconds (as _sample_worker)
+        gamma, task_seed, initial_membership = task
+        cd_start = time.time()
+        result = sample_resolution(G, engine, gamma, sample, task_seed, warm_start, initial_membership, edges)
+        return result, time.time() - cd_start
+
+    def to_bisect(resname1, resname2):
+        if round(resname2 - resname1, 4) <= min_diff_resolution:
             # LOGGER.debug('Reaching the minimum difference between resolutions')
-            continue
+            return False
         if bisect:
-            if resolution_graph.nodes[resname1]['value'] - resolution_graph.nodes[resname2]['value'] < min_diff_bisect_value:
-                # didn't do ensure monotonicity as Van Traag. not sure can that be a problem?
-                continue
+            membership1 = resolution_membership(cluG, resolution_graph.nodes[resname1])
+            membership2 = resolution_membership(cluG, resolution_graph.nodes[resname2])
+            if variation_of_information(membership1, membership2) < min_diff_vi:
+                return False
         if resolution_graph.nodes[resname1]['padded'] and resolution_graph.nodes[resname2]['padded']:
-            continue
-
-        # sample new resolutions and generate more partitions
-        new_resolution = np.round(np.sqrt(current_range[1] * current_range[0]), 4)
-        resname_new = '{:.4f}'.format(new_resolution)
-
-        stack_res_range.append((current_range[0], new_resolution))
-        stack_res_range.append((new_resolution, current_range[1]))
-        if sample<1:
-            G1 = network_perturb(G, sample)
-            new_partition = run_alg(G1, alg, new_resolution)
-        else:
-            new_partition = run_alg(G, alg, new_resolution)
-
-        LOGGER.info('Resolution:' + resname_new + '; find {} clusters'.format(len(new_partition)))
-
-        _ = update_resolution_graph(resolution_graph, new_resolution, new_partition, new_partition.total_weight_in_all_comms(), density, neighbors)
-
-        cluG.add_clusters(resolution_graph, new_resolution)
+            return False
+        return True
+
+    # clusters in a component of at least k clusters, and the number of consecutive levels that found nothing new
+    if patience is not None:
+        labels, sizes = cluG.component_sizes()
+        in_stable = sizes[labels] >= k
+    n_unchanged, converged = 0, False
+
+    # with a budget, the ranges are kept in a priority queue instead, the most informative first
+    anytime = time_budget is not None or max_runs is not None
+    queue = []
+    def push(current_range):
+        resname1, resname2 = current_range
+        width = np.log10(resname2 / resname1)
+        change = variation_of_information(resolution_membership(cluG, resolution_graph.nodes[resname1]),
+                                          resolution_membership(cluG, resolution_graph.nodes[resname2]))
+        heapq.heappush(queue, (-width * change, -width, current_range))
+    if anytime:
+        for current_range in stack_res_range:
+            push(current_range)
+        stack_res_range = []
+    n_runs = len(n_clusters)
+
+    n_pruned = 0
+    LOGGER.timeit('_sample')
+    try:
+        while stack_res_range or queue:
+            frontier, frontier_ranges = [], []
+            if anytime:
+                # the next batch (one range per worker) of the most informative ranges, within the budget
+                n_batch = max(workers, 1)
+                if max_runs is not None:
+                    n_batch = min(n_batch, (max_runs - n_runs) // replicates)
+                if time_budget is not None and time.time() - start_time >= time_budget:
+                    LOGGER.info('Time budget of {:.1f}s used up after {:d} runs of the CD algorithm'.format(time_budget, n_runs))
+                    break
+                if n_batch <= 0:
+                    LOGGER.info('Reached the maximum of {:d} runs of the CD algorithm'.format(max_runs))
+                    break
+                while queue and len(frontier) < n_batch:
+                    _, _, current_range = heapq.heappop(queue)
+                    if to_bisect(*current_range):
+                        frontier.append(float(np.sqrt(current_range[1] * current_range[0])))
+                        frontier_ranges.append(current_range)
+            else:
+                # the ranges in the stack form the current bisection level (frontier); all of them are checked
+                # against the same state before being sampled, so that the result does not depend on the number of workers
+                next_res_range = []
+                while stack_res_range:
+                    current_range = stack_res_range.pop(0)
+                    resname1, resname2 = current_range
+                    # LOGGER.debug('Current resolution range:{} {}'.format(resname1, resname2))
+
+                    if not to_bisect(resname1, resname2):
+                        continue
+
+                    # sample new resolutions and generate more partitions
+                    new_resolution = float(np.sqrt(current_range[1] * current_range[0]))
+
+                    next_res_range.append((current_range[0], new_resolution))
+                    next_res_range.append((new_resolution, current_range[1]))
+                    frontier.append(new_resolution)
+                stack_res_range = next_res_range
+
+            tasks = []
+            for new_resolution in frontier:
+                if warm_start:
+                    nearest = resolution_graph.nodes[resolution_graph.nearest(new_resolution)]
+                for r in range(replicates):
+                    initial_membership = None
+                    if warm_start:
+                        # start from the same replicate of the nearest resolution if it has one
+                        initial_membership = resolution_membership(cluG, nearest, r)
+                    tasks.append((new_resolution, resolution_seed(seed, new_resolution, r), initial_membership))
+            # the same run as the first one, from singletons, as a baseline of the warm starts; only a few times, as
+            # it is not used otherwise (and if the budget allows)
+            baseline = warm_start and tasks and len(cold_iterations) < COLD_BASELINE_RUNS and \
+                       (max_runs is None or n_runs + len(tasks) < max_runs)
+            if baseline:
+                tasks.append(tasks[0][:2] + (None,))
+            results = None if pool is None else pool.map(_sample_worker, tasks)
+            n_runs += len(tasks)
+
+            changed = False
+            for i, new_resolution in enumerate(frontier):
+                if pool is None:
+                    # without workers, the runs of one resolution at a time, so that each resolution is yielded as soon
+                    # as it is done; the tasks (and their warm starts) were fixed before the level, so this does not
+                    # change the result
+                    runs = [run_task(task) for task in tasks[i * replicates:(i + 1) * replicates]]
+                else:
+                    runs = results[i * replicates:(i + 1) * replicates]
+                run_results, cd_times = zip(*runs)
+                memberships, run_sizes, values, run_iterations = zip(*run_results)
+                resname_new = '{:.4f}'.format(new_resolution)
+                LOGGER.info('Resolution:' + resname_new + '; find {} clusters'.format('/'.join(str(n) for n in run_sizes)))
+                if warm_start:
+                    warm_iterations.extend(run_iterations)
+
+                membership = sp.sparse.vstack(memberships, format='csr')
+                replicate_ids = np.repeat(np.arange(replicates), [m.shape[0] for m in memberships])
+                _ = update_resolution_graph(resolution_graph, new_resolution, membership, np.mean(values), density, neighbors,
+                                            replicate_ids)
+
+                n_before = len(cluG._resolution)
+                new_row, new_col = cluG.add_clusters(resolution_graph, new_resolution)
+
+                if patience is not None:
+                    # a new cluster is novel unless it is connected to a cluster found before
+                    ids = resolution_graph.nodes[new_resolution]['node_indices']
+                    novel = np.setdiff1d(ids[ids >= n_before], np.concatenate([new_row[new_col < n_before],
+                                                                               new_col[new_row < n_before]]))
+                    # a new component is one whose clusters were not in any component of at least k clusters before
+                    labels, sizes = cluG.component_sizes()
+                    was_stable = np.bincount(labels[:n_before], weights=in_stable, minlength=len(sizes)) > 0
+                    n_new_components = np.count_nonzero((sizes >= k) & ~was_stable)
+                    in_stable = sizes[labels] >= k
+                    changed = changed or len(novel) > 0 or n_new_components > 0
+
+                yield ResolutionEvent(new_resolution, membership, resolution_graph.nodes[new_resolution]['node_indices'],
+                                      (new_row, new_col), time.time() - start_time, sum(cd_times), cluG)
+
+            if baseline:
+                cold, _ = run_task(tasks[-1]) if pool is None else results[-1]
+                cold_iterations.append(cold[3])
+
+            # a level is judged as a whole: within a level, the resolutions are in the order of the range, not of
+            # sampling, so a flat stretch of the range must not stop the sampling of the rest
+            if patience is not None and frontier:
+                n_unchanged = 0 if changed else n_unchanged + 1
+                converged = n_unchanged >= patience
+
+            # the halves of the sampled ranges are ranked once the new resolutions are known
+            for (resname1, resname2), new_resolution in zip(frontier_ranges, frontier):
+                push((resname1, new_resolution))
+                push((new_resolution, resname2))
+
+            if converged:
+                # the CD runs of the next bisection level are saved at least
+                pending = stack_res_range + [current_range for _, _, current_range in queue]
+                n_saved = replicates * sum(to_bisect(*r) for r in pending)
+                LOGGER.info('Sampling converged: the last {:d} bisection levels found no new cluster and no new '
+                            'component of {:d} clusters; at least {:d} runs of the CD algorithm saved'.format(patience, k, n_saved))
+                stack_res_range, queue = [], []
+
+            if prune is not None:
+                # the partitions of the visited resolutions are still used by warm starts, bisect and the priority of
+                # the ranges
+                n_pruned += cluG.prune(prune, lambda low, high: resolution_graph.settled(low, high, density),
+                                       keep_members=bool(warm_start or bisect or anytime))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
     # collapse related clusters
     LOGGER.report('Multiresolution Louvain clustering in %.2fs', '_sample')
+    LOGGER.info('{:d} distinct clusters out of {:d} found'.format(cluG.number_of_nodes(),
+                                                                  int(np.sum(cluG.counts(cluG.nodes())))))
+    if prune is not None:
+        LOGGER.info('{:d} unstable clusters pruned during sampling'.format(n_pruned))
+    if warm_start and warm_iterations and cold_iterations:
+        # both warm and cold starts are optimised until the partition is stable (whatever n_iterations is); the cold
+        # starts are measured at a few of the sampled resolutions only, so the saving is an estimate
+        n_saved = np.mean(cold_iterations) * len(warm_iterations) - np.sum(warm_iterations)
+        LOGGER.info('Warm start: {:d} optimiser iterations in {:d} runs; about {:.0f} iterations saved (estimate from '
+                    '{:d} cold starts at sampled resolutions, {:.1f} iterations on average, both optimised until '
+                    'stable)'.format(int(np.sum(warm_iterations)), len(warm_iterations), n_saved, len(cold_iterations),
+                                     np.mean(cold_iterations)))
+    return cluG
+
+def run(G,
+        density=0.1,
+        neighbors=10,
+        jaccard=0.75,
+        sample=0.9,
+        minres=0.01,
+        maxres=10,
+        alg='louvain',
+        maxn=None,
+        bisect=False,
+        workers=1,
+        seed=None,
+        warm_start=False,
+        replicates=1,
+        n_iterations=2,
+        names=None,
+        prune=None,
+        patience=None,
+        k=5,
+        time_budget=None,
+        max_runs=None,
+        all_to_all=False,
+        weight_floor=0.5,
+        minhash=0,
+        recall=0.95):
+    '''
+    Main function to run the Finder program
+    :param G: input network; an igraph graph, or a scipy.sparse adjacency matrix
+    (the other parameters are those of iter_run)
+    :return: the ClusterGraph
+    '''
+    for event in iter_run(G,
+                          density=density,
+                          neighbors=neighbors,
+                          jaccard=jaccard,
+                          sample=sample,
+                          minres=minres,
+                          maxres=maxres,
+                          alg=alg,
+                          maxn=maxn,
+                          bisect=bisect,
+                          workers=workers,
+                          seed=seed,
+                          warm_start=warm_start,
+                          replicates=replicates,
+                          n_iterations=n_iterations,
+                          names=names,
+                          prune=prune,
+                          patience=patience,
+                          k=k,
+                          time_budget=time_budget,
+                          max_runs=max_runs,
+                          all_to_all=all_to_all,
+                          weight_floor=weight_floor,
+                          minhash=minhash,
+                          recall=recall):
+        pass
+    return event.cluster_graph
+
+def merge_cluster_graphs(cluGs, vertex_indices, num_leaves):
+    '''
+    merge cluster graphs of subgraphs (e.g. connected components) into one cluster graph of the whole network
+    :param cluGs: a list of ClusterGraph objects
+    :param vertex_indices: a list of arrays; the i-th array maps the nodes of the i-th subgraph to the nodes of the network
+    :param num_leaves: number of nodes in the network
+    :return: the merged ClusterGraph; cluster ids are offset so that they stay unique
+    '''
+    merged = ClusterGraph(num_leaves, *((cluGs[0].graph['sim_threshold'], False, cluGs[0].graph['weight_floor'],
+                                         cluGs[0].graph.get('minhash', 0), cluGs[0].graph.get('recall', 0.95))
+                                        if cluGs else ()))
+    for cluG, vertices in zip(cluGs, vertex_indices):
+        ids = cluG.nodes()
+        mat = cluG.membership_matrix(ids)
+        # map the member indices of the subgraph to the network
+        mat = sp.sparse.csr_matrix((mat.data, np.asarray(vertices)[mat.indices], mat.indptr), shape=(len(ids), num_leaves))
+        new_ids = -np.ones(len(cluG._resolution), dtype=np.int64)
+        new_ids[ids] = merged.append_clusters(mat, cluG._resolution.array[ids], cluG._replicate.array[ids],
+                                              cluG.counts(ids))
+        merged._padded.array[new_ids[ids]] = cluG._padded.array[ids]
+        merged._res_min.array[new_ids[ids]] = cluG._res_min.array[ids]
+        merged._res_max.array[new_ids[ids]] = cluG._res_max.array[ids]
+        row, col, weight = cluG.edges(cluG.graph['weight_floor'], weight=True)
+        merged.add_edges(new_ids[row], new_ids[col], weight)
+    return merged
+
+def _run_component(task):
+    G, kwargs, deadline = task
+    if deadline is not None:
+        # the share of a component ends with the budget of the whole run at the latest
+        kwargs = dict(kwargs, time_budget=min(kwargs['time_budget'], max(deadline - time.time(), 0.0)))
+    return run(G, **kwargs)
+
+def run_components(G, minsize=10, workers=1, seed=None, maxn=None, names=None, time_budget=None, max_runs=None,
+                   **kwargs):
+    '''
+    Run the Finder program separately on each weakly connected component of the network, and merge the results
+    :param G: input network; an igraph graph, or a scipy.sparse adjacency matrix
+    :param minsize: components smaller than this size are not clustered (their nodes are in no cluster)
+    :param workers: number of processes. The largest component is sampled first with this many workers, then the
+    other components are distributed over this many processes
+    :param seed: seed of the run; each component gets its own seed derived from it
+    :param maxn: target number of clusters of the whole network; split among the components in proportion to their sizes
+    :param names: names of the nodes if G is an adjacency matrix (see adjacency_to_graph)
+    :param time_budget: seconds for the whole network; split among the components in proportion to their sizes (times
+    workers for the components sampled side by side), and no component goes on past the end of the whole budget. The
+    initial runs of each component (see run) are made in any case
+    :param max_runs: runs of the CD algorithm for the whole network; split among the components in proportion to their
+    sizes
+    :param kwargs: other parameters passed to run()
+    :return: a ClusterGraph over the whole network
+    '''
+    if sp.sparse.issparse(G):
+        G = adjacency_to_graph(G, names)
+    G.simplify(multiple=False)
+    if seed is None:
+        seed = np.random.randint(2**31 - 1)
+    all_components = G.components(mode='WEAK')
+    components = [np.sort(c) for c in all_components if len(c) >= minsize]
+    components = sorted(components, key=len, reverse=True)
+    n_small = len(all_components) - len(components)
+    if n_small:
+        LOGGER.info('Skipping {:d} components smaller than {:d} nodes'.format(n_small, minsize))
+    if not components:
+        raise ValueError('no component has at least %d nodes' % minsize)
+    n_total = sum(len(c) for c in components)
+    deadline = None if time_budget is None else time.time() + time_budget
+
+    tasks = []
+    for i, c in enumerate(components):
+        share = 1.0 * len(c) / n_total
+        sub_kwargs = dict(kwargs, seed=(seed + int(c[0])) % (2**31 - 1), workers=1)
+        if maxn is not None:
+            sub_kwargs['maxn'] = max(1, int(round(maxn * share)))
+        if time_budget is not None:
+            # the components after the largest one are sampled workers at a time
+            sub_kwargs['time_budget'] = time_budget * share * (workers if i > 0 and workers > 1 else 1)
+        if max_runs is not None:
+            sub_kwargs['max_runs'] = max(1, int(round(max_runs * share)))
+        # built from the vertices of the component only; a copy of the whole graph per component is quadratic when
+        # there are many small components (the vertices keep the order of c)
+        tasks.append((G.subgraph(c, implementation='create_from_scratch'), sub_kwargs, deadline))
+
+    LOGGER.timeit('_components')
+    LOGGER.info('Clustering {:d} components; the largest has {:d} nodes'.format(len(components), len(components[0])))
+    tasks[0][1]['workers'] = workers
+    cluGs = [_run_component(tasks[0])]
+    if workers > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            cluGs.extend(pool.map(_run_component, tasks[1:]))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        cluGs.extend(_run_component(task) for task in tasks[1:])
+    cluG = merge_cluster_graphs(cluGs, components, len(G.vs))
+    LOGGER.report('Clustering of all components in %.2fs', '_components')
     return cluG
 
 def consensus(cluG, k=5,  f=1.0, ct=100):
@@ -411,23 +1933,25 @@ def consensus(cluG, k=5,  f=1.0, ct=100):
     :return: 
     '''
 
-    components = [c for c in nx.connected_components(cluG) if len(c)>= k]
-    components = sorted(components, key=len, reverse=True)
+    # the size of a component is the number of clusters found, counting the repeats of identical clusters
+    counts = cluG.counts()
+    labels, sizes = cluG.component_sizes()
+    components = [c for c in cluG.connected_components() if sizes[labels[c[0]]] >= k]
+    components = sorted(components, key=lambda c: sizes[labels[c[0]]], reverse=True)
     components_new = []
     # use k-clique percolation to recalculate components
     for component in components:
-        component = list(component)
-        clusters = [cluG.nodes[v]['data'].binary for v in component]
-        mat = np.stack(clusters)
-        matsp = sp.sparse.coo_matrix(mat, )
-        matsp = matsp.tocsr()
-        jacmat = jaccard_matrix(matsp, matsp)
+        # a cluster found n times stands for n identical (fully connected) clusters; more than k copies do not change
+        # the percolation
+        component = np.repeat(component, np.minimum(counts[component], k))
+        matsp = cluG.membership_matrix(component)
+        if cluG.graph.get('minhash'):
+            na, nb = minhash_jaccard(matsp, cluG.signatures(component), recall=cluG.graph['recall'])
+        else:
+            na, nb = jaccard_matrix(matsp, matsp)
 
         Gcli = nx.Graph()
-        for i in range(len(jacmat[0])):
-            na, nb = jacmat[0][i], jacmat[1][i]
-            if na != nb:
-                Gcli.add_edge(na, nb)
+        Gcli.add_edges_from(zip(*(x[na != nb].tolist() for x in (na, nb))))
 
         clic_percolation = list(k_clique_communities(Gcli, k))  # this parameter better to stay
         for clic in clic_percolation:
@@ -436,14 +1960,14 @@ def consensus(cluG, k=5,  f=1.0, ct=100):
             components_new.append(set(original_nodes))
 
     components = components_new.copy()
-    components = sorted(components, key=len, reverse=True)
+    components = sorted(components, key=lambda c: np.sum(counts[list(c)]), reverse=True)
 
     ntaken = int(f * len(components))
     components = components[:ntaken]  #
 
 
     cluG_collapsed = collapse_cluster_graph(cluG, components, ct)
-    len_components = [len(c) for c in components]
+    len_components = [int(np.sum(counts[list(c)])) for c in components]
 
     cluG_collapsed_w_len = [(cluG_collapsed[i], len_components[i]) for i in range(len(cluG_collapsed))]
     cluG_collapsed_w_len = sorted(cluG_collapsed_w_len, key=lambda x: np.sum(x[0]), reverse=True)  # sort by cluster size
@@ -541,29 +2065,59 @@ if __name__ == '__main__':
     par.add_argument('--t', type=float, default=0.1, help='(inversed) density of sampling the resolution parameter; decrease this number to introduce more transient clusters (with longer running time);')
     par.add_argument('--k', type=int, default = 5, help='a parameter to pre-filter instable clusters')
     par.add_argument('--j', type=float, default=0.75, help='a jaccard index cutoff')
+    par.add_argument('--jfloor', type=float, default=0.5, help='also keep the similarities down to this jaccard index in the saved cluster graph, to view it at another cutoff later')
     par.add_argument('--minres', type=float, default=0.001, help='minimum resolution parameter')
     par.add_argument('--maxres', type=float, default=100.0, help='maximum resolution parameter')
     par.add_argument('--s', type=float, default=1.0, help='a subsample parameter')
     par.add_argument('--ct', default=75, type=int, help='threshold in collapsing cluster')
     par.add_argument('--o', required=True, help='output file in ddot format')
     par.add_argument('--alg', default='louvain', choices=['louvain', 'leiden'], help='add the option to use leiden algorithm')
+    par.add_argument('--iterations', type=int, default=2, help='number of iterations of the leiden algorithm; negative to iterate until stable')
+    par.add_argument('--workers', type=int, default=1, help='number of processes to sample resolutions in parallel')
+    par.add_argument('--seed', type=int, help='random seed of the run')
+    par.add_argument('--warm', action='store_true', help='start each run of the CD algorithm from the partition of the nearest sampled resolution')
+    par.add_argument('--r', type=int, default=1, help='number of perturbed replicates at each sampled resolution (see --s)')
+    par.add_argument('--bisect', type=float, nargs='?', const=True, default=False, help='only subdivide resolution ranges whose partitions differ by at least this normalized variation of information (0.01 if no value is given)')
+    par.add_argument('--patience', type=int, help='stop sampling once this many consecutive bisection levels found no new cluster and no new component of --k clusters')
+    par.add_argument('--budget', type=float, help='stop sampling after this many seconds, sampling the most informative resolution ranges first')
+    par.add_argument('--runs', type=int, help='stop sampling after this many runs of the CD algorithm, sampling the most informative resolution ranges first')
+    par.add_argument('--all', action='store_true', help='compare each new cluster with all the clusters found so far, instead of only those of nearby resolutions')
+    par.add_argument('--minhash', type=int, nargs='?', const=128, default=0, help='compare clusters approximately, through MinHash signatures of this length (128 if no value is given), for very large networks')
+    par.add_argument('--prune', action='store_true', help='remove the clusters that cannot pass the filter of --k during sampling, to save memory')
+    par.add_argument('--components', type=int, help='cluster each weakly connected component with at least this many nodes separately; smaller components are skipped')
     args = par.parse_args()
 
     G = ig.Graph.Read_Ncol(args.g) # redundant
     G_component  = list(G.components(mode='WEAK'))
-    if args.n != None:
+    if args.n != None and args.components is None:
         args.n = args.n + len(G_component) - 1
 
     # explore the resolution parameter given the number of clusters
-
-    cluG = run(G,
-               density=args.t,
-               jaccard=args.j,
-               sample=args.s,
-               minres=args.minres,
-               maxres=args.maxres,
-               maxn=args.n
-               )
+    kwargs = dict(alg=args.alg,
+                  n_iterations=args.iterations,
+                  density=args.t,
+                  jaccard=args.j,
+                  weight_floor=args.jfloor,
+                  sample=args.s,
+                  minres=args.minres,
+                  maxres=args.maxres,
+                  maxn=args.n,
+                  bisect=args.bisect,
+                  workers=args.workers,
+                  seed=args.seed,
+                  warm_start=args.warm,
+                  replicates=args.r,
+                  prune=args.k if args.prune else None,
+                  patience=args.patience,
+                  k=args.k,
+                  time_budget=args.budget,
+                  max_runs=args.runs,
+                  all_to_all=args.all,
+                  minhash=args.minhash)
+    if args.components is None:
+        cluG = run(G, **kwargs)
+    else:
+        cluG = run_components(G, minsize=args.components, **kwargs)
     # # use weaver to organize them (due to the previous collapsed step, need to re-calculate containment index. This may be ok
     # components = sorted(nx.connected_components(cluG), key=len, reverse=True)
     filename = args.o + '.cluG'
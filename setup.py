@@ -32,20 +32,20 @@ setup(
 
         'License :: OSI Approved :: MIT License',
 
-        'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3 :: Only',
         'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
     ],
 
     keywords='hierarchy tree DAG',
     packages=find_packages(exclude=['contrib', 'docs', 'tests']), 
 
-    python_requires='>=2.7, !=3.0.*, !=3.1.*, !=3.2.*, !=3.3.*, <4',
-    install_requires=['numpy', 'networkx'], 
+    python_requires='>=3.7, <4',
+    install_requires=['numpy>=1.17', 'networkx'], 
 
     project_urls={ 
         'Bug Reports': 'https://https://github.com/HierLab/HiDeF/issues',
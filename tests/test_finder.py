@@ -0,0 +1,201 @@
+'''
+Checks of hidef.finder: the array-based parts against straightforward versions of the same computations (the dense
+or list-based code they replaced, or brute force over all pairs), on small random inputs; and the guarantees of the
+options of run, on small planted-partition networks.
+
+usage: python -m pytest tests
+'''
+import itertools
+import numpy as np
+import scipy as sp
+import scipy.sparse
+import networkx as nx
+import igraph as ig
+from hidef import finder
+
+def dense_jaccard(matA, matB, threshold):
+    '''the default path of jaccard_matrix before the sparse-output version: a dense 'either' matrix and np.where'''
+    both = matA.astype(int).dot(matB.astype(int).T).toarray()
+    either = (np.tile(matA.getnnz(axis=1), (matB.shape[0], 1)) + matB.getnnz(axis=1)[:, np.newaxis]).T - both
+    return np.where(1.0 * both / either > threshold)
+
+def list_membership_matrix(membership, minsize):
+    '''the list-based partition_to_membership_matrix, on the clusters of a membership vector (in the order of labels)'''
+    clusters = [np.flatnonzero(membership == label).tolist() for label in range(membership.max() + 1)]
+    clusters = sorted([p for p in clusters if len(p) >= minsize], key=len, reverse=True)
+    row, col = [], []
+    for i in range(len(clusters)):
+        row.extend([i for _ in clusters[i]])
+        col.extend([x for x in clusters[i]])
+    C = sp.sparse.coo_matrix((np.ones(len(row), dtype=int), (row, col)), shape=(len(clusters), len(membership)))
+    return C.tocsr()
+
+def clusters_matrix(clusters, n):
+    '''membership matrix of a list of sorted member arrays'''
+    indptr = np.r_[0, np.cumsum([len(c) for c in clusters])]
+    return sp.sparse.csr_matrix((np.ones(indptr[-1], dtype=bool), np.concatenate(clusters), indptr),
+                                shape=(len(clusters), n))
+
+def random_cluster_graph(rng, n_clusters=60, n=40):
+    '''a cluster graph of random clusters (some found several times), random weighted edges and a few removals'''
+    cluG = finder.ClusterGraph(n, sim_threshold=0.75, weight_floor=0.5)
+    for res in range(n_clusters // 10):
+        sizes = rng.integers(1, 8, size=10)
+        clusters = [np.sort(rng.choice(n, size=s, replace=False)) for s in sizes]
+        # found again at a later resolution
+        clusters += [cluG.members(i) for i in rng.choice(len(cluG._resolution), size=3)] if len(cluG._resolution) else []
+        cluG.append_clusters(clusters_matrix(clusters, n), 0.1 * (res + 1))
+        n_ids = len(cluG._resolution)
+        row, col = rng.integers(0, n_ids, size=(2, n_ids // 2))
+        cluG.add_edges(row, col, rng.uniform(0.5, 1.0, size=len(row)))
+    cluG.remove_nodes_from(rng.choice(len(cluG._resolution), size=5, replace=False))
+    return cluG
+
+def edge_set(cluG, threshold=None):
+    row, col, weight = cluG.edges(threshold, weight=True)
+    return sorted(zip(np.minimum(row, col).tolist(), np.maximum(row, col).tolist(), weight.tolist()))
+
+def planted_partition(seed, n_blocks=4, block_size=40, p_in=0.25, p_out=0.02):
+    '''an igraph graph with n_blocks dense blocks'''
+    rng = np.random.default_rng(seed)
+    blocks = np.repeat(np.arange(n_blocks), block_size)
+    A = np.triu(rng.random((len(blocks), len(blocks))) < np.where(blocks[:, None] == blocks[None, :], p_in, p_out), 1)
+    return ig.Graph(n=len(blocks), edges=np.argwhere(A).tolist())
+
+def signature(cluG):
+    '''the clusters (members, count and resolution span, by id) and the weighted edges of a cluster graph'''
+    clusters = [(i, tuple(cluG.members(i).tolist()), int(cluG.counts()[i]), cluG.resolution_span(i))
+                for i in cluG.nodes().tolist()]
+    return clusters, edge_set(cluG, cluG.graph['weight_floor'])
+
+def consensus_signature(cluG, k=5):
+    return [(tuple(np.flatnonzero(c).tolist()), n) for c, n in finder.consensus(cluG, k, 1.0, 75)]
+
+def test_cluster_graph_store():
+    for seed in range(5):
+        cluG = random_cluster_graph(np.random.default_rng(seed))
+        ids = cluG.nodes()
+        members = [cluG.members(i).tolist() for i in ids]
+        mat = cluG.membership_matrix(ids)
+        assert [mat.indices[mat.indptr[r]:mat.indptr[r + 1]].tolist() for r in range(len(ids))] == members
+        edges = edge_set(cluG, cluG.graph['weight_floor'])
+        assert len(set((i, j) for i, j, _ in edges)) == len(edges)
+        assert set(i for e in edges for i in e[:2]) <= set(ids.tolist())
+        assert sorted(cluG.to_networkx(data=False).edges()) == [(i, j) for i, j, w in edges if w > 0.75]
+
+        # compaction only drops the removed clusters from the stores
+        cluG.compact()
+        assert np.array_equal(cluG.nodes(), ids)
+        assert [cluG.members(i).tolist() for i in ids] == members
+        assert edge_set(cluG, cluG.graph['weight_floor']) == edges
+
+def test_partition_to_membership_matrix():
+    for seed, minsize in itertools.product(range(5), [1, 4]):
+        rng = np.random.default_rng(seed)
+        # few labels, so that there are ties between sizes
+        membership = rng.integers(0, 12, 100)
+        C = finder.partition_to_membership_matrix(membership, minsize=minsize)
+        expected = list_membership_matrix(membership, minsize)
+        assert C.shape == expected.shape
+        assert np.array_equal(C.indptr, expected.indptr) and np.array_equal(C.indices, expected.indices)
+
+def test_interning():
+    rng = np.random.default_rng(0)
+    n = 30
+    clusters = [np.sort(rng.choice(n, size=s, replace=False)) for s in [3, 5, 5, 8]]
+    cluG = finder.ClusterGraph(n)
+    first = cluG.append_clusters(clusters_matrix(clusters, n), 0.1)
+    # the same clusters at another resolution, and twice in one matrix
+    second = cluG.append_clusters(clusters_matrix(clusters[::-1] + clusters[:1], n), 0.4)
+    assert np.array_equal(second, np.r_[first[::-1], first[:1]])
+    assert cluG.number_of_nodes() == len(clusters)
+    assert cluG.counts().tolist() == [3, 2, 2, 2]
+    assert all(cluG.resolution_span(i) == (0.1, 0.4) for i in first)
+    assert [cluG.find(c) for c in clusters] == first.tolist()
+    assert cluG.find(np.arange(n)) == -1
+
+def test_size_bound_pairs():
+    for seed, threshold in itertools.product(range(5), [0.5, 0.75, 0.9]):
+        rng = np.random.default_rng(seed)
+        sizeA, sizeB = rng.integers(1, 20, 30), rng.integers(1, 20, 40)
+        expected = [(i, j) for i in range(len(sizeA)) for j in range(len(sizeB))
+                    if 1.0 * min(sizeA[i], sizeB[j]) / max(sizeA[i], sizeB[j]) >= threshold]
+        idA, idB = finder.size_bound_pairs(sizeA, sizeB, threshold)
+        assert list(zip(idA.tolist(), idB.tolist())) == expected
+        assert finder.size_bound_work(sizeA, sizeB, threshold) == sum(sizeA[i] + sizeB[j] for i, j in expected)
+
+def test_jaccard_matrix_no_pair():
+    # sizes far apart: the default returns no pair without the product, like the other paths
+    membership = np.repeat(np.arange(4), 10)
+    matA = finder.partition_to_membership_matrix(membership, minsize=1)
+    matB = finder.partition_to_membership_matrix(np.r_[np.zeros(36, dtype=int), np.arange(1, 5)], minsize=1)
+    for prefilter in (True, False, None):
+        idA, idB, jac = finder.jaccard_matrix(matA, matB, 0.5, prefilter=prefilter, return_values=True)
+        assert len(idA) == len(idB) == len(jac) == 0
+
+def test_jaccard_matrix():
+    for seed, threshold in itertools.product(range(5), [0.25, 0.5, 0.75]):
+        rng = np.random.default_rng(seed)
+        n = 200
+        matA = finder.partition_to_membership_matrix(rng.integers(0, 10, n), minsize=1)
+        # a partition close to the first one, so that some pairs pass the threshold
+        membership = rng.integers(0, 10, n)
+        moved = rng.random(n) < 0.8
+        membership[moved] = finder.membership_matrix_to_membership(matA)[moved]
+        matB = finder.partition_to_membership_matrix(membership, minsize=1)
+        expected = dense_jaccard(matA, matB, threshold)
+        for prefilter in (True, False, None):
+            idA, idB, jac = finder.jaccard_matrix(matA, matB, threshold, prefilter=prefilter, return_values=True)
+            assert np.array_equal(idA, expected[0]) and np.array_equal(idB, expected[1])
+            assert np.allclose(jac, finder.jaccard_pairs(matA, matB, idA, idB))
+
+def test_lsh_pairs():
+    for seed in range(5):
+        rng = np.random.default_rng(seed)
+        # few distinct keys, so that the buckets have several clusters
+        keys = rng.integers(0, 6, size=(50, 4)).astype(np.uint64)
+        expected = sorted(set((i, j) for band in keys.T for i in range(len(band)) for j in range(i + 1, len(band))
+                              if band[i] == band[j]))
+        i, j = finder.lsh_pairs(keys)
+        assert list(zip(i.tolist(), j.tolist())) == expected
+
+def test_connected_components():
+    for seed in range(5):
+        cluG = random_cluster_graph(np.random.default_rng(seed))
+        expected = sorted((sorted(c) for c in nx.connected_components(cluG.to_networkx(data=False))), key=min)
+        assert [c.tolist() for c in cluG.connected_components()] == expected
+
+        labels, sizes = cluG.component_sizes()
+        counts = cluG.counts()
+        for c in expected:
+            assert len(set(labels[c].tolist())) == 1
+            assert sizes[labels[c[0]]] == np.sum(counts[c])
+        assert len(set(labels[c[0]] for c in expected)) == len(expected)
+
+        # a view at another threshold rebuilds the components from the kept edges
+        view = cluG.threshold(0.6)
+        expected = sorted((sorted(c) for c in nx.connected_components(view.to_networkx(data=False))), key=min)
+        assert [c.tolist() for c in view.connected_components()] == expected
+
+def test_workers():
+    # the cluster graph does not depend on the number of workers
+    for kwargs in [{}, dict(warm_start=True), dict(replicates=2), dict(prune=5)]:
+        G = planted_partition(0)
+        expected = signature(finder.run(G, alg='leiden', sample=0.8, density=0.2, seed=1, workers=1, **kwargs))
+        assert signature(finder.run(G, alg='leiden', sample=0.8, density=0.2, seed=1, workers=3, **kwargs)) == expected
+
+def test_prune():
+    # pruning does not change the consensus with the same k, in any sampling mode
+    for kwargs in [{}, dict(warm_start=True), dict(bisect=True), dict(max_runs=60)]:
+        G = planted_partition(1)
+        expected = consensus_signature(finder.run(G, alg='leiden', sample=0.8, seed=2, **kwargs))
+        assert consensus_signature(finder.run(G, alg='leiden', sample=0.8, seed=2, prune=5, **kwargs)) == expected
+
+def test_threshold():
+    # a view at a lower cutoff is the cluster graph that a run at this cutoff builds
+    G = planted_partition(2)
+    view = finder.run(G, alg='leiden', sample=0.8, seed=3, jaccard=0.75).threshold(0.6)
+    cluG = finder.run(G, alg='leiden', sample=0.8, seed=3, jaccard=0.6)
+    assert edge_set(view) == edge_set(cluG)
+    assert [c.tolist() for c in view.connected_components()] == [c.tolist() for c in cluG.connected_components()]
+    assert consensus_signature(view) == consensus_signature(cluG)